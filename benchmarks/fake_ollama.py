@@ -0,0 +1,119 @@
+# Stand-in for Ollama's /api/generate, so load tests measure the app rather than a real model.
+# Answers after a fixed prompt latency plus reply tokens at a configurable rate; streaming requests
+# get NDJSON chunks, one per token, like Ollama. Responses carry the fields the app reads
+# (response, context, prompt_eval_count/_duration, eval_count/_duration).
+#
+#   python benchmarks/fake_ollama.py --port 11435 --latency-ms 300 --tokens-per-second 40 --reply-tokens 30
+#   LLM_API_URL=http://127.0.0.1:11435/api/generate uvicorn main:app
+import argparse, json, random, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY_WORDS = [
+    "Great", "choice", "the", "V8", "gives", "you", "smooth", "power", "out", "of", "corners", "and",
+    "slicks", "will", "grip", "well", "in", "the", "dry", "let's", "look", "at", "your", "rear", "wing",
+    "next", "high", "downforce", "helps", "through", "fast", "turns",
+]
+
+class FakeOllama(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+    stats = {"requests": 0, "active": 0, "max_active": 0}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/api/generate":
+            self.send_error(404)
+            return
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["active"] += 1
+            self.stats["max_active"] = max(self.stats["max_active"], self.stats["active"])
+        try:
+            self.generate(payload)
+        finally:
+            with self.lock:
+                self.stats["active"] -= 1
+
+    def generate(self, payload: dict):
+        cfg = self.config
+        prompt = (payload.get("system") or "") + (payload.get("prompt") or "")
+        prompt_tokens = max(1, len(prompt) // 4)
+        reused = len(payload.get("context") or [])
+        # Prompt evaluation scales with the tokens not already in the reused context
+        prompt_seconds = cfg.latency_ms / 1000 + prompt_tokens / cfg.prompt_tokens_per_second
+        time.sleep(prompt_seconds)
+
+        n_tokens = min(cfg.reply_tokens, (payload.get("options") or {}).get("num_predict", cfg.reply_tokens))
+        words = [random.choice(REPLY_WORDS) for _ in range(n_tokens)]
+        context = list(range(reused + prompt_tokens + n_tokens))
+        per_token = 1 / cfg.tokens_per_second
+        final = {
+            "model": payload.get("model", "fake"),
+            "done": True,
+            "context": context,
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prompt_seconds * 1e9),
+            "eval_count": n_tokens,
+            "eval_duration": int(per_token * n_tokens * 1e9),
+        }
+
+        if payload.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i, word in enumerate(words):
+                time.sleep(per_token)
+                self.write_chunk({"response": word + (" " if i < len(words) - 1 else "."), "done": False})
+            self.write_chunk({**final, "response": ""})
+            self.wfile.write(b"0\r\n\r\n")
+            return
+
+        time.sleep(per_token * n_tokens)
+        body = json.dumps({**final, "response": " ".join(words) + "."}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, data: dict):
+        line = json.dumps(data).encode() + b"\n"
+        self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        # /stats: how many generations the app actually sent (to check coalescing / caching)
+        body = json.dumps(self.stats).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fake Ollama /api/generate server for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency-ms", type=float, default=200, help="fixed latency before the first token")
+    parser.add_argument("--prompt-tokens-per-second", type=float, default=2000)
+    parser.add_argument("--tokens-per-second", type=float, default=40, help="reply generation rate")
+    parser.add_argument("--reply-tokens", type=int, default=30)
+    return parser.parse_args(argv)
+
+def serve(args) -> ThreadingHTTPServer:
+    FakeOllama.config = args
+    server = ThreadingHTTPServer((args.host, args.port), FakeOllama)
+    server.daemon_threads = True
+    return server
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = serve(args)
+    print(f"Fake Ollama on http://{args.host}:{args.port}/api/generate "
+          f"({args.latency_ms}ms + {args.tokens_per_second} tok/s x {args.reply_tokens} tokens)")
+    server.serve_forever()
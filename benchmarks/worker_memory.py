@@ -0,0 +1,136 @@
+# Per-worker memory of a multi-worker deployment, in each sentiment sharing mode:
+#
+#   separate  every worker loads its own model              (SENTIMENT_SHARE=off)
+#   preload   model loaded in the gunicorn master, shared copy-on-write after fork
+#   remote    model loaded once in sentiment_server.py, workers call it over a Unix socket
+#
+#   python benchmarks/worker_memory.py --workers 4                    # all three modes
+#   python benchmarks/worker_memory.py --modes preload remote --workers 8
+#   python benchmarks/worker_memory.py --pid 12345                   # an already running tree
+#
+# RSS counts shared pages in every process that maps them, so the sum over workers overstates real
+# usage; PSS splits shared pages between the processes sharing them and sums to the true total.
+# Needs Linux (/proc/<pid>/smaps_rollup), gunicorn, and the app's usual environment (.env).
+import argparse, json, os, signal, subprocess, sys, time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = {
+    "separate": {"SENTIMENT_SHARE": "off"},
+    "preload": {"SENTIMENT_SHARE": "preload"},
+    "remote": {"SENTIMENT_SHARE": "off", "SENTIMENT_BACKEND": "remote"},
+}
+
+def memory_of(pid: int) -> dict:
+    # kB values from smaps_rollup, converted to MB
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    with open(f"/proc/{pid}/cmdline", "rb") as f:
+        cmd = f.read().replace(b"\0", b" ").decode(errors="replace").strip()
+    return {
+        "pid": pid,
+        "cmd": cmd[:60],
+        "rss": fields.get("Rss", 0.0),
+        "pss": fields.get("Pss", 0.0),
+        "uss": fields.get("Private_Clean", 0.0) + fields.get("Private_Dirty", 0.0),
+        "shared": fields.get("Shared_Clean", 0.0) + fields.get("Shared_Dirty", 0.0),
+    }
+
+def process_tree(pid: int) -> list:
+    pids = [pid]
+    for task in os.listdir(f"/proc/{pid}/task"):
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                for child in f.read().split():
+                    pids.extend(process_tree(int(child)))
+        except FileNotFoundError:
+            pass
+    return pids
+
+def wait_ready(port: int, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=2) as response:
+                if response.status == 200:
+                    return True
+        except Exception:
+            pass
+        time.sleep(1)
+    return False
+
+def measure(pids: list) -> list:
+    rows = []
+    for pid in pids:
+        try:
+            rows.append(memory_of(pid))
+        except (FileNotFoundError, ProcessLookupError):
+            pass
+    return rows
+
+def report(title: str, rows: list) -> dict:
+    print(f"\n== {title}")
+    print(f"{'pid':>8}  {'RSS MB':>9}{'PSS MB':>9}{'USS MB':>9}{'shared':>9}  command")
+    for r in rows:
+        print(f"{r['pid']:>8}  {r['rss']:>9.1f}{r['pss']:>9.1f}{r['uss']:>9.1f}{r['shared']:>9.1f}  {r['cmd']}")
+    total = {key: sum(r[key] for r in rows) for key in ("rss", "pss", "uss")}
+    print(f"{'total':>8}  {total['rss']:>9.1f}{total['pss']:>9.1f}{total['uss']:>9.1f}")
+    return {"processes": rows, "total": total}
+
+def run_mode(mode: str, args) -> dict:
+    env = dict(os.environ, **MODES[mode], WEB_CONCURRENCY=str(args.workers), BIND=f"127.0.0.1:{args.port}",
+               SENTIMENT_WARMUP="eager")
+    procs = []
+    try:
+        if mode == "remote":
+            server = subprocess.Popen([sys.executable, "sentiment_server.py"], cwd=ROOT, env=env)
+            procs.append(server)
+            socket_path = env.get("SENTIMENT_SOCKET", "/tmp/npc-sentiment.sock")
+            deadline = time.monotonic() + args.timeout
+            while not os.path.exists(socket_path) and time.monotonic() < deadline:
+                time.sleep(0.5)
+        app = subprocess.Popen(["gunicorn", "main:app", "-c", "gunicorn.conf.py"], cwd=ROOT, env=env)
+        procs.append(app)
+        if not wait_ready(args.port, args.timeout):
+            raise RuntimeError(f"{mode}: app did not become ready within {args.timeout}s")
+        time.sleep(args.settle)  # let every worker finish its warmup
+        pids = [pid for proc in procs for pid in process_tree(proc.pid)]
+        return report(f"{mode} ({args.workers} workers)", measure(pids))
+    finally:
+        for proc in reversed(procs):
+            proc.send_signal(signal.SIGTERM)
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure per-worker RSS/PSS for each sentiment sharing mode.")
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for startup")
+    parser.add_argument("--settle", type=float, default=15, help="seconds to wait after /ready")
+    parser.add_argument("--pid", type=int, help="measure this process and its children instead of launching")
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    if args.pid:
+        results = {"pid": report(f"process tree of {args.pid}", measure(process_tree(args.pid)))}
+    else:
+        results = {mode: run_mode(mode, args) for mode in args.modes}
+        print(f"\n{'mode':<10}{'total RSS':>12}{'total PSS':>12}{'PSS/worker':>12}")
+        for mode, result in results.items():
+            total = result["total"]
+            print(f"{mode:<10}{total['rss']:>10.1f}MB{total['pss']:>10.1f}MB{total['pss'] / args.workers:>10.1f}MB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import os, time, asyncio
+from contextlib import contextmanager
+from database import SessionLocal
+from models import NPCMemory
+from sentiment import analyze_sentiment, analyze_sentiment_async, analyze_sentiment_batch
+from context_cache import load_player_context_async, load_player_contexts
+from memory_index import recall_turns_async, MEMORY_RETRIEVAL_K
+from metrics import STAGE_SECONDS
+
+# /chat_batch limits: items per request, and NPC replies generated at once for one batch
+CHAT_BATCH_MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "100"))
+CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "4"))
+
+# A chat turn split into stages. Stages that don't depend on each other run concurrently:
+#   prepare  = player sentiment  ||  player context (history, names, latest build)  ||  semantic recall
+#   llm      = NPC reply generation
+#   db       = insert of the turn
+# NPC-side sentiment isn't needed for the reply, so it is scored after the response is sent.
+
+class StageTimer:
+    # Stage durations go to the Server-Timing header and to the npc_stage_seconds histogram
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    def _record(self, name: str, seconds: float):
+        self.stages[name] = seconds
+        STAGE_SECONDS.observe(seconds, self.endpoint, name)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, time.perf_counter() - start)
+
+    async def run(self, name: str, awaitable):
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self._record(name, time.perf_counter() - start)
+
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        # Server-Timing header (durations in ms), readable by browser devtools and the load tests
+        parts = [f"{name};dur={round(seconds * 1000, 1)}" for name, seconds in self.stages.items()]
+        parts.append(f"total;dur={round(self.total() * 1000, 1)}")
+        return ", ".join(parts)
+
+    def log(self, label: str):
+        total = self.total()
+        serial = sum(self.stages.values())
+        stages = " ".join(f"{name}={round(seconds, 3)}s" for name, seconds in self.stages.items())
+        print(f"⏱️ {label}: {stages} | total={round(total, 3)}s (serial sum {round(serial, 3)}s)")
+
+async def prepare_chat_turn(player_id: int, dialogue: str, timer: StageTimer, turns_needed: int = 2, before_load=None):
+    # Player sentiment, the context reads and semantic recall are independent, so they overlap.
+    # Recall fetches extra hits because some may be among the recent turns (see merge_recalled).
+    return await asyncio.gather(
+        timer.run("context", load_player_context_async(SessionLocal, player_id, turns_needed, before_load)),
+        timer.run("sentiment", analyze_sentiment_async(dialogue)),
+        timer.run("recall", recall_turns_async(player_id, dialogue, k=MEMORY_RETRIEVAL_K + turns_needed)),
+    )
+
+def read_player_contexts(player_ids: list, turns_needed: int, before_load=None) -> dict:
+    db = SessionLocal()
+    try:
+        return load_player_contexts(db, player_ids, turns_needed, before_load)
+    finally:
+        db.close()
+
+async def prepare_chat_batch(items: list, timer: StageTimer, turns_needed: int = 2, before_load=None):
+    # Batch counterpart of prepare_chat_turn: set-based context reads for every player, one batched
+    # sentiment pass over all dialogues, and per-item recall, all overlapping
+    player_ids = [item.player_id for item in items]
+    return await asyncio.gather(
+        timer.run("context", asyncio.to_thread(read_player_contexts, player_ids, turns_needed, before_load)),
+        timer.run("sentiment", asyncio.to_thread(analyze_sentiment_batch, [item.dialogue for item in items])),
+        timer.run("recall", asyncio.gather(*(
+            recall_turns_async(item.player_id, item.dialogue, k=MEMORY_RETRIEVAL_K + turns_needed) for item in items
+        ))),
+    )
+
+def persist_turn(player_id: int, npc_id: int, dialogue: str, sentiment: str, npc_reply: str, npc_sentiment: str = None) -> int:
+    db = SessionLocal()
+    try:
+        memory = NPCMemory(
+            player_id=player_id,
+            npc_id=npc_id,
+            dialogue=dialogue,
+            sentiment=sentiment,
+            npc_reply=npc_reply,
+            npc_sentiment=npc_sentiment
+        )
+        db.add(memory)
+        db.flush()
+        memory_id = memory.id
+        db.commit()
+        return memory_id
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def persist_turns(rows: list) -> list:
+    # Inserts many turns in one flush (SQLAlchemy sends them as multi-row INSERTs); returns their ids in order
+    db = SessionLocal()
+    try:
+        memories = [NPCMemory(**row) for row in rows]
+        db.add_all(memories)
+        db.flush()
+        ids = [memory.id for memory in memories]
+        db.commit()
+        return ids
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def score_npc_sentiment(memory_id: int, npc_reply: str):
+    # Runs as a background task after the reply has been returned
+    try:
+        npc_sentiment = analyze_sentiment(npc_reply)
+    except Exception as e:
+        print("NPC sentiment scoring failed: ", e)
+        return
+    db = SessionLocal()
+    try:
+        db.query(NPCMemory).filter(NPCMemory.id == memory_id).update({"npc_sentiment": npc_sentiment})
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print("DB update error (npc_sentiment): ", e)
+    finally:
+        db.close()
+
+def score_npc_sentiments(turns: list):
+    # Batch version of score_npc_sentiment for (memory_id, npc_reply) pairs: one sentiment pass, one bulk update
+    try:
+        labels = analyze_sentiment_batch([npc_reply for _, npc_reply in turns])
+    except Exception as e:
+        print("NPC sentiment scoring failed: ", e)
+        return
+    db = SessionLocal()
+    try:
+        db.bulk_update_mappings(NPCMemory, [
+            {"id": memory_id, "npc_sentiment": label} for (memory_id, _), label in zip(turns, labels)
+        ])
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print("DB update error (npc_sentiment): ", e)
+    finally:
+        db.close()
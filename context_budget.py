@@ -0,0 +1,131 @@
+import os, threading
+from collections import OrderedDict
+
+# Token-accurate prompt budgeting. The system prompt, build, mood and player dialogue always go in;
+# chat history fills whatever is left of the model's context window, newest turns first.
+# Token counts come from the model's own tokenizer (LLM_TOKENIZER, a Hugging Face tokenizer id) and
+# fall back to a ~4 chars/token estimate when it can't be loaded. The tokenizer loads on a background
+# thread and the estimate is used until it is ready, so counting never blocks a request (or the event
+# loop) on the download. Counts of stored turns are cached, so each turn is tokenized once instead of
+# on every request.
+LLM_TOKENIZER = os.getenv("LLM_TOKENIZER", "microsoft/Phi-3-mini-4k-instruct")
+LLM_CONTEXT_TOKENS = int(os.getenv("LLM_CONTEXT_TOKENS", "4096"))
+LLM_NUM_PREDICT = int(os.getenv("LLM_NUM_PREDICT", "200"))
+LLM_PROMPT_MARGIN = int(os.getenv("LLM_PROMPT_MARGIN", "64"))  # chat-template / special tokens
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "8192"))
+CHARS_PER_TOKEN = 4
+
+_tokenizer = None
+_tokenizer_state = {"status": "not_loaded", "error": None}
+_tokenizer_lock = threading.Lock()
+_loader = {"started": False}
+_loader_lock = threading.Lock()
+
+def get_tokenizer():
+    # Loaded on first use; None means the chars/token estimate is in use
+    global _tokenizer
+    if _tokenizer_state["status"] != "not_loaded":
+        return _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer_state["status"] == "not_loaded":
+            try:
+                from transformers import AutoTokenizer
+                _tokenizer = AutoTokenizer.from_pretrained(LLM_TOKENIZER)
+                _tokenizer_state["status"] = "loaded"
+                print(f"🔢 Context budget: using {LLM_TOKENIZER} tokenizer")
+            except Exception as e:
+                _tokenizer_state.update(status="estimate", error=str(e))
+                print(f"⚠️ Could not load tokenizer {LLM_TOKENIZER}, estimating {CHARS_PER_TOKEN} chars/token: {e}")
+    return _tokenizer
+
+def start_tokenizer_load():
+    with _loader_lock:
+        if _loader["started"]:
+            return
+        _loader["started"] = True
+    threading.Thread(target=get_tokenizer, name="tokenizer-load", daemon=True).start()
+
+def tokenizer_settled() -> bool:
+    # True once counts are final: the tokenizer loaded, or failed and the estimate is here to stay
+    return _tokenizer_state["status"] != "not_loaded"
+
+def ready_tokenizer():
+    # Never waits: None (estimate) while the tokenizer is still loading
+    if not tokenizer_settled():
+        start_tokenizer_load()
+    return _tokenizer
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    tokenizer = ready_tokenizer()
+    if tokenizer is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+class TokenCountCache:
+    def __init__(self, max_entries: int = 8192):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, key, text: str) -> int:
+        with self._lock:
+            tokens = self._entries.get(key)
+            if tokens is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return tokens
+            self.misses += 1
+        settled = tokenizer_settled()
+        tokens = count_tokens(text)
+        if self.max_entries > 0 and settled:
+            # Estimates made while the tokenizer loads aren't kept, so the turn is recounted once it's ready
+            with self._lock:
+                self._entries[key] = tokens
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return tokens
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "tokenizer": LLM_TOKENIZER if _tokenizer_state["status"] == "loaded" else _tokenizer_state["status"],
+            }
+
+token_counts = TokenCountCache(TOKEN_CACHE_SIZE)
+
+def prompt_budget() -> int:
+    # Tokens available for system + prompt once the reply and template overhead are reserved
+    return LLM_CONTEXT_TOKENS - LLM_NUM_PREDICT - LLM_PROMPT_MARGIN
+
+def format_turn(turn) -> str:
+    return " ".join(f"Player: {turn.dialogue} NPC: {turn.npc_reply}".split())
+
+def turn_tokens(turn, line: str = None) -> int:
+    # Keyed by row id plus the text itself, so an edited interaction gets recounted
+    line = line if line is not None else format_turn(turn)
+    return token_counts.count((getattr(turn, "id", None), hash(line)), line)
+
+def fit_history(turns: list, budget: int) -> tuple:
+    # Keeps the newest turns that fit in `budget` tokens; returns (context text oldest-first, tokens used)
+    kept = []
+    used = 0
+    for turn in reversed(turns):
+        line = format_turn(turn)
+        tokens = turn_tokens(turn, line) + 1  # newline separator
+        if used + tokens > budget:
+            break
+        kept.append(line)
+        used += tokens
+    return "\n".join(reversed(kept)), used
+
+def token_cache_stats() -> dict:
+    return token_counts.stats()
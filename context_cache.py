@@ -0,0 +1,295 @@
+import os, time, asyncio, threading
+from collections import OrderedDict
+from types import SimpleNamespace
+from sqlalchemy import func
+from models import NPCMemory, Player, CarBuild, PlayerMemorySummary
+
+# Per-player conversation context (recent turns, player names, latest build, memory summary) kept in process so a
+# chat turn doesn't need three DB round-trips before the LLM starts. Entries are plain snapshots,
+# never ORM instances, so they stay valid after the session that loaded them is closed.
+CONTEXT_CACHE_SIZE = int(os.getenv("CONTEXT_CACHE_SIZE", "2048"))
+CONTEXT_CACHE_TTL = float(os.getenv("CONTEXT_CACHE_TTL", "300"))
+CONTEXT_CACHE_TURNS = int(os.getenv("CONTEXT_CACHE_TURNS", "8"))
+
+BUILD_FIELDS = ["id", "player_id", "chassis", "engine", "tires", "frontWing", "rearWing", "car_image", "timestamp"]
+TURN_FIELDS = ["id", "player_id", "npc_id", "dialogue", "sentiment", "timestamp", "npc_reply", "npc_sentiment"]
+
+def snapshot(obj, fields):
+    return SimpleNamespace(**{field: getattr(obj, field, None) for field in fields}) if obj is not None else None
+
+class PlayerContext:
+    def __init__(self, name, display_name, build, turns: list, complete: bool, capacity: int, summary: str = None, summary_through: int = 0):
+        self.name = name
+        self.display_name = display_name
+        self.build = build
+        self.summary = summary      # rolling summary of turns older than the recent ones
+        self.summary_through = summary_through  # id of the last turn folded into the summary
+        self.turns = turns          # oldest first, at most `capacity`
+        self.complete = complete    # True when turns hold the player's entire history
+        self.capacity = capacity
+        self.loaded_at = time.monotonic()
+
+    @property
+    def player_name(self):
+        return self.display_name or self.name
+
+    def recent_turns(self, limit: int) -> list:
+        return self.turns[-limit:] if limit > 0 else []
+
+    def unsummarized_turns(self, minimum: int, limit: int) -> list:
+        # Turns after the summary watermark (at least the last `minimum`, at most the last `limit`);
+        # turns without an id are still queued for write-behind, so newer than any summary
+        pending = sum(1 for turn in self.turns if turn.id is None or turn.id > self.summary_through)
+        return self.recent_turns(min(max(pending, minimum), limit))
+
+class PlayerContextCache:
+    def __init__(self, max_players: int = 2048, ttl_seconds: float = 300):
+        self.max_players = max_players
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pinned = {}           # player_id -> open connections (WebSocket chat) holding the entry
+        self._lock = threading.Lock()
+
+    def get(self, player_id: int, turns_needed: int = 0):
+        with self._lock:
+            entry = self._entries.get(player_id)
+            if entry is not None and player_id not in self._pinned and time.monotonic() - entry.loaded_at > self.ttl_seconds:
+                del self._entries[player_id]
+                entry = None
+            if entry is None or (len(entry.turns) < turns_needed and not entry.complete):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(player_id)
+            self.hits += 1
+            return entry
+
+    def put(self, player_id: int, entry: PlayerContext):
+        if self.max_players <= 0:
+            return
+        with self._lock:
+            self._entries[player_id] = entry
+            self._entries.move_to_end(player_id)
+            while len(self._entries) > self.max_players:
+                victim = next((key for key in self._entries if key not in self._pinned), None)
+                if victim is None:
+                    break
+                del self._entries[victim]
+
+    def pin(self, player_id: int):
+        # Pinned entries skip TTL expiry and LRU eviction; invalidate() and write-through still apply
+        with self._lock:
+            self._pinned[player_id] = self._pinned.get(player_id, 0) + 1
+
+    def unpin(self, player_id: int):
+        with self._lock:
+            count = self._pinned.get(player_id, 0) - 1
+            if count > 0:
+                self._pinned[player_id] = count
+            else:
+                self._pinned.pop(player_id, None)
+
+    def record_turn(self, player_id: int, turn):
+        # Write-through for a newly stored NPCMemory row; players not in the cache are left alone
+        with self._lock:
+            entry = self._entries.get(player_id)
+            if entry is None:
+                return
+            entry.turns.append(turn)
+            if len(entry.turns) > entry.capacity:
+                del entry.turns[:-entry.capacity]
+                entry.complete = False
+
+    def set_build(self, player_id: int, build):
+        with self._lock:
+            entry = self._entries.get(player_id)
+            if entry is not None:
+                entry.build = build
+
+    def set_summary(self, player_id: int, summary: str, summary_through: int):
+        with self._lock:
+            entry = self._entries.get(player_id)
+            if entry is not None:
+                entry.summary = summary
+                entry.summary_through = summary_through
+
+    def invalidate(self, player_id: int):
+        with self._lock:
+            self._entries.pop(player_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "pinned": len(self._pinned),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+context_cache = PlayerContextCache(CONTEXT_CACHE_SIZE, CONTEXT_CACHE_TTL)
+
+def fetch_player(db, player_id: int):
+    return db.query(Player).filter(Player.id == player_id).first()
+
+def fetch_history(db, player_id: int, limit: int) -> list:
+    return (
+        db.query(NPCMemory)
+        .filter(NPCMemory.player_id == player_id)
+        .order_by(NPCMemory.timestamp.desc())
+        .limit(limit)
+        .all()
+    )
+
+def fetch_latest_build(db, player_id: int):
+    return (
+        db.query(CarBuild)
+        .filter(CarBuild.player_id == player_id)
+        .order_by(CarBuild.id.desc())
+        .first()
+    )
+
+def fetch_summary(db, player_id: int) -> tuple:
+    # (summary, id of the last turn it covers); (None, 0) before the first fold
+    row = db.query(PlayerMemorySummary).filter(PlayerMemorySummary.player_id == player_id).first()
+    return (row.summary or None, row.last_memory_id or 0) if row else (None, 0)
+
+def build_player_context(player, history: list, build, fetch: int, summary: tuple = (None, 0)) -> PlayerContext:
+    return PlayerContext(
+        name=player.name,
+        display_name=player.display_name,
+        build=snapshot(build, BUILD_FIELDS),
+        turns=[snapshot(turn, TURN_FIELDS) for turn in reversed(history)],
+        complete=len(history) < fetch,
+        capacity=fetch,
+        summary=summary[0],
+        summary_through=summary[1],
+    )
+
+def load_player_context(db, player_id: int, turns_needed: int = 2, before_load=None):
+    # Returns the cached PlayerContext, loading it from the DB on a miss; None if the player doesn't exist.
+    # before_load(player_id) runs only on a miss, e.g. to wait for queued write-behind rows.
+    entry = context_cache.get(player_id, turns_needed)
+    if entry is not None:
+        return entry
+    if before_load is not None:
+        before_load(player_id)
+
+    player = fetch_player(db, player_id)
+    if not player:
+        return None
+    fetch = max(turns_needed, CONTEXT_CACHE_TURNS)
+    entry = build_player_context(
+        player, fetch_history(db, player_id, fetch), fetch_latest_build(db, player_id), fetch, fetch_summary(db, player_id)
+    )
+    context_cache.put(player_id, entry)
+    return entry
+
+async def load_player_context_async(session_factory, player_id: int, turns_needed: int = 2, before_load=None):
+    # Same as load_player_context, but on a miss the reads run concurrently, each in a
+    # worker thread with its own session, so a remote DB costs one round-trip instead of four
+    entry = context_cache.get(player_id, turns_needed)
+    if entry is not None:
+        return entry
+    if before_load is not None:
+        await asyncio.to_thread(before_load, player_id)
+
+    def read(fn, *args):
+        db = session_factory()
+        try:
+            result = fn(db, *args)
+            db.expunge_all()
+            return result
+        finally:
+            db.close()
+
+    fetch = max(turns_needed, CONTEXT_CACHE_TURNS)
+    player, history, build, summary = await asyncio.gather(
+        asyncio.to_thread(read, fetch_player, player_id),
+        asyncio.to_thread(read, fetch_history, player_id, fetch),
+        asyncio.to_thread(read, fetch_latest_build, player_id),
+        asyncio.to_thread(read, fetch_summary, player_id),
+    )
+    if not player:
+        return None
+    entry = build_player_context(player, history, build, fetch, summary)
+    context_cache.put(player_id, entry)
+    return entry
+
+def load_player_contexts(db, player_ids: list, turns_needed: int = 2, before_load=None) -> dict:
+    # Batch version of load_player_context: {player_id: PlayerContext} for the players that exist.
+    # Cache misses are loaded with four set-based queries, however many players are missing.
+    contexts, missing = {}, []
+    for player_id in dict.fromkeys(player_ids):
+        entry = context_cache.get(player_id, turns_needed)
+        if entry is not None:
+            contexts[player_id] = entry
+        else:
+            missing.append(player_id)
+    if not missing:
+        return contexts
+    if before_load is not None:
+        for player_id in missing:
+            before_load(player_id)
+
+    fetch = max(turns_needed, CONTEXT_CACHE_TURNS)
+    players = db.query(Player).filter(Player.id.in_(missing)).all()
+    # Latest `fetch` turns of every player in one pass: rank each player's rows newest first
+    ranked = (
+        db.query(
+            NPCMemory.id.label("id"),
+            func.row_number().over(partition_by=NPCMemory.player_id, order_by=NPCMemory.timestamp.desc()).label("rank"),
+        )
+        .filter(NPCMemory.player_id.in_(missing))
+        .subquery()
+    )
+    history = (
+        db.query(NPCMemory)
+        .join(ranked, NPCMemory.id == ranked.c.id)
+        .filter(ranked.c.rank <= fetch)
+        .order_by(NPCMemory.player_id, NPCMemory.timestamp.desc())
+        .all()
+    )
+    latest = (
+        db.query(func.max(CarBuild.id).label("id"))
+        .filter(CarBuild.player_id.in_(missing))
+        .group_by(CarBuild.player_id)
+        .subquery()
+    )
+    builds = {build.player_id: build for build in db.query(CarBuild).join(latest, CarBuild.id == latest.c.id)}
+    summaries = {
+        row.player_id: (row.summary or None, row.last_memory_id or 0)
+        for row in db.query(PlayerMemorySummary).filter(PlayerMemorySummary.player_id.in_(missing))
+    }
+
+    turns_by_player = {}
+    for turn in history:
+        turns_by_player.setdefault(turn.player_id, []).append(turn)
+    for player in players:
+        entry = build_player_context(
+            player, turns_by_player.get(player.id, []), builds.get(player.id), fetch, summaries.get(player.id, (None, 0))
+        )
+        context_cache.put(player.id, entry)
+        contexts[player.id] = entry
+    return contexts
+
+def record_turn(player_id: int, npc_id: int, dialogue: str, sentiment: str, npc_reply: str, npc_sentiment: str = None, id: int = None, timestamp=None):
+    context_cache.record_turn(player_id, SimpleNamespace(
+        id=id, player_id=player_id, npc_id=npc_id, dialogue=dialogue, sentiment=sentiment,
+        timestamp=timestamp, npc_reply=npc_reply, npc_sentiment=npc_sentiment,
+    ))
+
+def record_build(player_id: int, build):
+    context_cache.set_build(player_id, snapshot(build, BUILD_FIELDS))
+
+def record_summary(player_id: int, summary: str, summary_through: int):
+    context_cache.set_summary(player_id, summary, summary_through)
+
+def invalidate_player(player_id: int):
+    context_cache.invalidate(player_id)
@@ -7,8 +7,9 @@ import os
 load_dotenv()  # 👈 loads variables from .env
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-# Create database engine
-engine = create_engine(DATABASE_URL)
+# Create database engine (SQLite connections are used from several threads: threadpool, background writers)
+connect_args = {"check_same_thread": False} if DATABASE_URL and DATABASE_URL.startswith("sqlite") else {}
+engine = create_engine(DATABASE_URL, connect_args=connect_args)
 
 # Session setup for interacting with the database
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -1,9 +1,15 @@
-import requests, os, time, json
+import httpx, os, re, time, json, random, threading
+from collections import OrderedDict
 from dotenv import load_dotenv
+from llm_client import get_llm_client, LLMStatusError
+from llm_scheduler import LLMBusyError
+from context_budget import count_tokens, fit_history, prompt_budget, LLM_CONTEXT_TOKENS, LLM_NUM_PREDICT
+from metrics import LLM_PROMPT_TOKENS, LLM_PROMPT_EVAL_SECONDS, LLM_EVAL_TOKENS, LLM_EVAL_SECONDS
 load_dotenv() 
 
-def build_dax_prompt(player_name, sentiment, mood_instruction, build_context, context_prompt,  player_dialogue):
-    return f"""
+# Static instruction block, sent as Ollama's `system` message when a session starts. It only changes
+# with the player's name; a reused Ollama `context` already contains it, so it is not sent again.
+DAX_SYSTEM_TEMPLATE = """
     You are Dax, a real human F1 race engineer helping {player_name}. 
     Always begin by greeting the player by name:    
     
@@ -35,24 +41,214 @@ def build_dax_prompt(player_name, sentiment, mood_instruction, build_context, co
     - Tires: C5 Slick, Full Wet
     - Front Wing: High Lift, Simple Outwash
     - Rear Wing: High Downforce, Low Drag
-    
+"""
+
+def build_dax_system_prompt(player_name):
+    return DAX_SYSTEM_TEMPLATE.format(player_name=player_name)
+
+def build_dax_turn_prompt(sentiment, mood_instruction, build_context, context_prompt, player_dialogue, memory_summary=""):
+    # Per-turn part; with a reused session context the chat history is already in the model's KV cache
+    summary_line = f"\n    What you remember from earlier sessions: {memory_summary}" if memory_summary else ""
+    context_line = f"\n    Recent Chat Context: {context_prompt}" if context_prompt else ""
+    return f"""
     Current Build (if any): {build_context}
-    Mood: {sentiment}.{mood_instruction}
-    Recent Chat Context: {context_prompt}
+    Mood: {sentiment}.{mood_instruction}{summary_line}{context_line}
     Player: "{player_dialogue}"
     Dax:
         """
 
-def generate_npc_response(player_dialogue: str, sentiment: str, player_id: int, context: list = [], player_name: str = "", build=None) -> str:
+def build_dax_prompt(player_name, sentiment, mood_instruction, build_context, context_prompt,  player_dialogue, memory_summary=""):
+    return build_dax_system_prompt(player_name) + build_dax_turn_prompt(sentiment, mood_instruction, build_context, context_prompt, player_dialogue, memory_summary)
 
-    context_prompt = ""
-    for entry in context:
-        context_prompt += f"Player: {entry.dialogue}\nNPC: {entry.npc_reply}\n"
+# Per-player Ollama conversation `context` (token ids of everything evaluated so far). Reusing it
+# means only the new turn's tokens are evaluated. Entries remember the last exchange they contain
+# so a context that missed turns (e.g. served by another worker) is dropped instead of reused, and
+# every exchange rendered into it so recalled turns it has not seen yet can still be sent.
+LLM_MODEL = os.getenv("LLM_MODEL", "phi3:mini")
+LLM_KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE", "30m")
+LLM_SESSION_CACHE_SIZE = int(os.getenv("LLM_SESSION_CACHE_SIZE", "1024"))
+LLM_SESSION_MAX_TOKENS = int(os.getenv("LLM_SESSION_MAX_TOKENS", "1536"))
+
+_session_contexts = OrderedDict()
+_session_lock = threading.Lock()
+_prompt_eval_stats = {
+    "reused": {"requests": 0, "tokens": 0, "seconds": 0.0},
+    "fresh": {"requests": 0, "tokens": 0, "seconds": 0.0},
+    # Replies served from another caller's generation; no prompt was evaluated for them
+    "shared": {"reply_cache": 0, "coalesced": 0},
+}
+
+class NPCPayload(dict):
+    # The Ollama request body plus the exchanges its prompt holds (not serialized)
+    exchanges = frozenset()
+
+def get_session(player_id, history: list):
+    if player_id is None:
+        return None
+    with _session_lock:
+        entry = _session_contexts.get(player_id)
+        if entry is None:
+            return None
+        last = history[-1] if history else None
+        if last is None or (last.dialogue, last.npc_reply) != entry["last_exchange"]:
+            del _session_contexts[player_id]
+            return None
+        _session_contexts.move_to_end(player_id)
+        return entry
+
+def save_session_context(player_id, tokens: list, player_dialogue: str, npc_reply: str, exchanges=frozenset()):
+    if player_id is None or not tokens:
+        return
+    with _session_lock:
+        if len(tokens) > LLM_SESSION_MAX_TOKENS:
+            # Too long to keep extending; the next turn starts fresh from the DB history
+            _session_contexts.pop(player_id, None)
+            return
+        last_exchange = (player_dialogue, npc_reply)
+        _session_contexts[player_id] = {"tokens": tokens, "last_exchange": last_exchange, "exchanges": frozenset(exchanges) | {last_exchange}}
+        _session_contexts.move_to_end(player_id)
+        while len(_session_contexts) > LLM_SESSION_CACHE_SIZE:
+            _session_contexts.popitem(last=False)
+
+def reset_session_context(player_id):
+    with _session_lock:
+        _session_contexts.pop(player_id, None)
+
+def record_generation(payload: dict, data: dict, npc_reply: str, player_id=None, player_dialogue: str = None, shared: str = None):
+    # Logs prompt-eval cost (Ollama reports durations in ns) and keeps the new context for the player.
+    # A shared reply (reply cache / coalesced) only counts as such: its generation was recorded once already.
+    if shared:
+        with _session_lock:
+            _prompt_eval_stats["shared"][shared] += 1
+        save_session_context(player_id, data.get("context"), player_dialogue, npc_reply, getattr(payload, "exchanges", frozenset()))
+        return
+    tokens = data.get("prompt_eval_count") or 0
+    seconds = (data.get("prompt_eval_duration") or 0) / 1e9
+    kind = "reused" if payload.get("context") else "fresh"
+    LLM_PROMPT_TOKENS.observe(tokens, kind)
+    LLM_PROMPT_EVAL_SECONDS.observe(seconds, kind)
+    if data.get("eval_count"):
+        LLM_EVAL_TOKENS.observe(data["eval_count"])
+        LLM_EVAL_SECONDS.observe((data.get("eval_duration") or 0) / 1e9)
+    with _session_lock:
+        stats = _prompt_eval_stats[kind]
+        stats["requests"] += 1
+        stats["tokens"] += tokens
+        stats["seconds"] += seconds
+    print(f"🧠 Prompt eval ({kind} context): {tokens} tokens in {round(seconds, 3)}s")
+    save_session_context(player_id, data.get("context"), player_dialogue, npc_reply, getattr(payload, "exchanges", frozenset()))
+
+def prompt_eval_stats() -> dict:
+    with _session_lock:
+        return {kind: dict(stats) for kind, stats in _prompt_eval_stats.items()}
+
+# Small-talk fast path: messages made only of greeting phrases (plus filler like "dax" or "today")
+# are answered from templates instead of asking the LLM to classify and answer them.
+SMALL_TALK_PHRASES = [
+    "hi", "hello", "hey", "yo", "how are you", "how are you doing", "what's up", "whats up", "sup",
+    "how's it going", "hows it going", "how is it going", "how's your day", "hows your day",
+    "how is your day", "what's new", "whats new", "good morning", "good afternoon", "good evening",
+    "good night",
+]
+SMALL_TALK_FILLER = ["dax", "there", "buddy", "mate", "man", "friend", "today", "doing", "again", "so", "well"]
+
+# Matched word by word (longest phrase first), so the cost is linear in the message length
+SMALL_TALK_PHRASE_WORDS = {tuple(phrase.split()) for phrase in SMALL_TALK_PHRASES}
+SMALL_TALK_FILLER_WORDS = set(SMALL_TALK_FILLER)
+SMALL_TALK_LONGEST = max(len(words) for words in SMALL_TALK_PHRASE_WORDS)
+SMALL_TALK_MAX_CHARS = 80   # longer messages always go to the LLM
+
+FIRST_GREETINGS = [
+    "Hey {name}! I’m Dax, your race engineer.",
+    "Hey {name}! Dax here, your race engineer.",
+]
+RETURN_GREETINGS = [
+    "Hey {name}, good to see you again!",
+    "Hey {name}, welcome back to the garage!",
+]
+SMALL_TALK_HINTS = {
+    "chassis": ["Doing great, thanks for asking—let’s jump into chassis choices: Standard Monocoque or Ground Effect Optimized?"],
+    "engine": ["All good here—time to pick an engine: the 2004 V10 or the 2006 V8?"],
+    "tires": ["Doing well, thanks—next up are tires: C5 Slick for the dry or Full Wet for rain?"],
+    "frontWing": ["Great, thanks—let’s sort your front wing: High Lift or Simple Outwash?"],
+    "rearWing": ["Doing great—last piece is the rear wing: High Downforce or Low Drag?"],
+    "complete": [
+        "I’m great, thanks—your {engine} with {tires} tires looks race-ready, want some strategy tips?",
+        "All good here—that {chassis} build is complete, ready to talk race strategy?",
+    ],
+}
+BUILD_PARTS = ["chassis", "engine", "tires", "frontWing", "rearWing"]
+
+SMALL_TALK_FAST_PATH = os.getenv("SMALL_TALK_FAST_PATH", "1") == "1"
+
+_small_talk_stats = {"checked": 0, "hits": 0}
+_small_talk_lock = threading.Lock()
+
+def normalize_small_talk(text: str) -> str:
+    text = text.lower().replace("’", "'").replace("‘", "'")
+    text = re.sub(r"[^a-z' ]+", " ", text)
+    return " ".join(text.split())
+
+def is_small_talk(player_dialogue: str) -> bool:
+    # True when the message is only greeting phrases and filler words, with at least one phrase
+    if len(player_dialogue) > SMALL_TALK_MAX_CHARS:
+        return False
+    words = normalize_small_talk(player_dialogue).split()
+    i, has_phrase = 0, False
+    while i < len(words):
+        for size in range(min(SMALL_TALK_LONGEST, len(words) - i), 0, -1):
+            if tuple(words[i:i + size]) in SMALL_TALK_PHRASE_WORDS:
+                i += size
+                has_phrase = True
+                break
+        else:
+            if words[i] not in SMALL_TALK_FILLER_WORDS:
+                return False
+            i += 1
+    return has_phrase
+
+def small_talk_reply(player_dialogue: str, player_name: str = "", build=None, context: list = []) -> str:
+    # Returns a templated reply for small talk, or None when the message needs the LLM
+    if not SMALL_TALK_FAST_PATH:
+        return None
+    hit = is_small_talk(player_dialogue)
+    with _small_talk_lock:
+        _small_talk_stats["checked"] += 1
+        if hit:
+            _small_talk_stats["hits"] += 1
+    if not hit:
+        return None
+
+    name = player_name or "there"
+    greeting = random.choice(RETURN_GREETINGS if context else FIRST_GREETINGS).format(name=name)
+    missing = [part for part in BUILD_PARTS if not (build and getattr(build, part, None))]
+    hint_key = missing[0] if missing else "complete"
+    parts = {part: getattr(build, part, "") for part in BUILD_PARTS} if build else {}
+    hint = random.choice(SMALL_TALK_HINTS[hint_key]).format(**parts)
+    return f"{greeting} {hint}"
+
+def small_talk_stats() -> dict:
+    with _small_talk_lock:
+        checked = _small_talk_stats["checked"]
+        hits = _small_talk_stats["hits"]
+    return {"checked": checked, "hits": hits, "misses": checked - hits, "hit_rate": round(hits / checked, 4) if checked else 0.0}
 
-    context_prompt = " ".join(context_prompt.split()[-300:]).strip()  
+def answer_small_talk(player_dialogue: str, player_id, context: list, player_name: str, build) -> str:
+    reply = small_talk_reply(player_dialogue, player_name, build, context)
+    if reply is None:
+        return None
+    stats = small_talk_stats()
+    print(f"💬 Small-talk fast path, LLM skipped (hit rate {stats['hits']}/{stats['checked']})")
+    # Keep a still-valid Ollama context usable: the templated exchange becomes the session's last turn
+    session = get_session(player_id, context)
+    if session:
+        save_session_context(player_id, session["tokens"], player_dialogue, reply, session["exchanges"])
+    return reply
 
-    if not context_prompt:
-        context_prompt = "No recent conversation. Assume this is the start of the mission."
+def build_npc_payload(player_dialogue: str, sentiment: str, player_id: int = None, context: list = [], player_name: str = "", build=None, summary: str = None) -> dict:
+
+    session = get_session(player_id, context)
+    session_context = session["tokens"] if session else None
 
     mood_instruction = ""  
     if sentiment.lower() == "positive" or sentiment.lower() == "happy":
@@ -79,100 +275,182 @@ def generate_npc_response(player_dialogue: str, sentiment: str, player_id: int,
         if all([build.chassis, build.engine, build.tires, build.frontWing, build.rearWing]):
             mood_instruction += " The car build is complete. Praise the player or give final strategy tips."
 
-    # First prompt with full context
-    full_prompt = build_dax_prompt(player_name, sentiment, mood_instruction, build_context, context_prompt, player_dialogue)
+    # Fit everything into the model's context window: system prompt, build, mood, memory summary and
+    # dialogue are fixed, chat history gets the remaining tokens (newest turns first). A reused session
+    # context already holds the system prompt, summary and history, so none of them is sent again
+    # (Ollama would render a `system` field into the template again on every call); only turns it
+    # has not seen (memories recalled for this message) are rendered, within the remaining budget.
+    system_prompt = build_dax_system_prompt(player_name)
+    budget = prompt_budget()
+    fixed_tokens = count_tokens(build_dax_turn_prompt(sentiment, mood_instruction, build_context, "", player_dialogue))
+    if session_context and fixed_tokens + len(session_context) > budget:
+        print("🧠 Session context exceeds the token budget — rebuilding from chat history.")
+        session_context = None
 
-    # Fallback if too long
-    if len(full_prompt.split()) > 1200:
-        print("🧠 Prompt too long — truncating context.")
-        context_prompt = " ".join(context_prompt.split()[-800:]).strip()
-        full_prompt = build_dax_prompt(player_name, sentiment, mood_instruction, build_context, context_prompt, player_dialogue)
+    context_prompt = ""
+    memory_summary = ""
+    exchanges = frozenset()
+    if session_context is None:
+        memory_summary = summary or ""
+        fixed_tokens += count_tokens(system_prompt) + count_tokens(memory_summary)
+        context_prompt, history_tokens = fit_history(context, max(0, budget - fixed_tokens))
+        kept = len(context_prompt.splitlines())
+        if kept < len(context):
+            print(f"🧠 Context trimmed to {kept}/{len(context)} turns ({history_tokens} tokens) to fit {budget} tokens.")
+        exchanges = frozenset((turn.dialogue, turn.npc_reply) for turn in context[len(context) - kept:])
+        if not context:
+            context_prompt = "No recent conversation. Assume this is the start of the mission."
+    else:
+        exchanges = session["exchanges"]
+        unseen = [turn for turn in context if (turn.dialogue, turn.npc_reply) not in exchanges]
+        if unseen:
+            context_prompt, history_tokens = fit_history(unseen, max(0, budget - fixed_tokens - len(session_context)))
+            kept = len(context_prompt.splitlines())
+            if kept:
+                print(f"🧠 Reused context plus {kept}/{len(unseen)} recalled turns ({history_tokens} tokens).")
+            exchanges = exchanges | {(turn.dialogue, turn.npc_reply) for turn in unseen[len(unseen) - kept:]}
+    if fixed_tokens > budget:
+        print(f"⚠️ Prompt is {fixed_tokens} tokens before history, over the {budget} token budget.")
 
-    llm_api_url = os.getenv("LLM_API_URL")
-    if not llm_api_url:
-        raise ValueError("Missing environment variable: LLM_API_URL")
-    llm_user = os.getenv("LLM_API_USERNAME")
-    llm_pass = os.getenv("LLM_API_PASSWORD")
+    turn_prompt = build_dax_turn_prompt(sentiment, mood_instruction, build_context, context_prompt, player_dialogue, memory_summary)
 
-    auth = (llm_user, llm_pass) if llm_user and llm_pass else None
-    
-    payload = {
-        "model": "phi3:mini",
-        "prompt": full_prompt,
+    payload = NPCPayload({
+        "model": LLM_MODEL,
+        "prompt": turn_prompt,
         "stream": False,
+        "keep_alive": LLM_KEEP_ALIVE,
         "options": {
             "temperature": 0.5,
-            "num_predict": 200
+            "num_predict": LLM_NUM_PREDICT,
+            # The window the prompt was budgeted for; Ollama's default num_ctx can be smaller
+            "num_ctx": LLM_CONTEXT_TOKENS
         }
-    }
-
-    try:
-        start_time = time.time()
-        response = requests.post(
-            "http://localhost:11434/api/generate",
-            json=payload,
-            timeout=300
-        )
+    })
+    payload.exchanges = exchanges
+    if session_context:
+        payload["context"] = session_context
+    else:
+        payload["system"] = system_prompt
+    return payload
 
-        # Log response details for debugging
-        print(f"Response status: {response.status_code}")
-        if response.status_code != 200:
-            print(f"Response headers: {response.headers}")
-            print(f"Response text: {response.text}")
+def parse_llm_response(response, payload: dict = None, player_id=None, player_dialogue: str = None) -> str:
+    # Log response details for debugging
+    print(f"Response status: {response.status_code}")
+    if response.status_code != 200:
+        print(f"Response headers: {response.headers}")
+        print(f"Response text: {response.text}")
 
-        if response.status_code == 200:
-            raw_response = response.text.strip()
-            print(f"RAW LLM response (first 500 chars):\n{raw_response[:500]}")
+    if response.status_code == 200:
+        raw_response = response.text.strip()
+        print(f"RAW LLM response (first 500 chars):\n{raw_response[:500]}")
 
-            # Handle Ollama's JSON response format
-            try:
-                # Ollama returns JSON with a "response" field
-                data = json.loads(raw_response)
-                
-                # Extract the actual response text
-                if isinstance(data, dict) and "response" in data:
-                    return data["response"].strip()
-                else:
-                    print(f"Unexpected JSON structure: {data}")
-                    return "⚠️ Unexpected response format from LLM service."
-                    
-            except json.JSONDecodeError as e:
-                print(f"JSON parse error: {e}")
-                print(f"Raw response that failed to parse: {raw_response}")
+        # Handle Ollama's JSON response format
+        try:
+            # Ollama returns JSON with a "response" field
+            data = json.loads(raw_response)
+            
+            # Extract the actual response text
+            if isinstance(data, dict) and "response" in data:
+                npc_reply = data["response"].strip()
+                if payload is not None:
+                    record_generation(payload, data, npc_reply, player_id, player_dialogue, getattr(response, "source", None))
+                return npc_reply
+            else:
+                print(f"Unexpected JSON structure: {data}")
+                return "⚠️ Unexpected response format from LLM service."
                 
-                # Fallback: treat as plain text if JSON parsing fails
-                # Sometimes the response might be plain text instead of JSON
-                if raw_response:
-                    return raw_response.strip()
-                else:
-                    return "⚠️ Empty response from LLM service."
-        else:
-            # Handle non-200 status codes
-            print(f"LLM API returned status {response.status_code}: {response.text}")
+        except json.JSONDecodeError as e:
+            print(f"JSON parse error: {e}")
+            print(f"Raw response that failed to parse: {raw_response}")
             
-            # Specific handling for common Ollama errors
-            if response.status_code == 500:
-                error_text = response.text.lower()
-                if "memory" in error_text:
-                    return "⚠️ Insufficient memory for model. Try restarting Ollama or using a smaller model."
-                elif "terminated" in error_text or "exit status" in error_text:
-                    return "⚠️ Model process crashed. Please restart Ollama service."
-                else:
-                    return "⚠️ LLM service internal error. Check Ollama logs."
-            elif response.status_code == 404:
-                return "⚠️ Model not found. Please check if phi3:mini is installed (ollama pull phi3:mini)."
+            # Fallback: treat as plain text if JSON parsing fails
+            # Sometimes the response might be plain text instead of JSON
+            if raw_response:
+                return raw_response.strip()
             else:
-                return f"⚠️ LLM service error (status {response.status_code})."
+                return "⚠️ Empty response from LLM service."
+    else:
+        # Handle non-200 status codes
+        print(f"LLM API returned status {response.status_code}: {response.text}")
+        
+        # Specific handling for common Ollama errors
+        if response.status_code == 500:
+            error_text = response.text.lower()
+            if "memory" in error_text:
+                return "⚠️ Insufficient memory for model. Try restarting Ollama or using a smaller model."
+            elif "terminated" in error_text or "exit status" in error_text:
+                return "⚠️ Model process crashed. Please restart Ollama service."
+            else:
+                return "⚠️ LLM service internal error. Check Ollama logs."
+        elif response.status_code == 404:
+            return f"⚠️ Model not found. Please check if {LLM_MODEL} is installed (ollama pull {LLM_MODEL})."
+        else:
+            return f"⚠️ LLM service error (status {response.status_code})."
 
-    except requests.exceptions.Timeout:
+def llm_error_message(e: Exception) -> str:
+    if isinstance(e, httpx.TimeoutException):
         print("Request timed out")
         return "⚠️ LLM service timeout. Please try again."
-    except requests.exceptions.ConnectionError:
+    if isinstance(e, httpx.ConnectError):
         print("Connection error - is Ollama running?")
         return "⚠️ Cannot connect to LLM service. Please check if Ollama is running."
-    except requests.exceptions.RequestException as e:
+    if isinstance(e, httpx.HTTPError):
         print(f"Request error: {e}")
         return "⚠️ Connection error to LLM service."
+    print(f"Unexpected error: {e}")
+    return "⚠️ Unexpected error occurred."
+
+def generate_npc_response(player_dialogue: str, sentiment: str, player_id: int = None, context: list = [], player_name: str = "", build=None, timeout: float = None, summary: str = None) -> str:
+    reply = answer_small_talk(player_dialogue, player_id, context, player_name, build)
+    if reply is not None:
+        return reply
+    payload = build_npc_payload(player_dialogue, sentiment, player_id, context, player_name, build, summary)
+    client = get_llm_client()
+    try:
+        response = client.generate_sync(payload, timeout=timeout)
+    except LLMBusyError:
+        raise
+    except Exception as e:
+        return llm_error_message(e)
+    return parse_llm_response(response, payload, player_id, player_dialogue)
+
+async def generate_npc_response_async(player_dialogue: str, sentiment: str, player_id: int = None, context: list = [], player_name: str = "", build=None, timeout: float = None, summary: str = None) -> str:
+    reply = answer_small_talk(player_dialogue, player_id, context, player_name, build)
+    if reply is not None:
+        return reply
+    payload = build_npc_payload(player_dialogue, sentiment, player_id, context, player_name, build, summary)
+    client = get_llm_client()
+    try:
+        response = await client.generate(payload, timeout=timeout)
+    except LLMBusyError:
+        raise
+    except Exception as e:
+        return llm_error_message(e)
+    return parse_llm_response(response, payload, player_id, player_dialogue)
+
+async def stream_npc_response(player_dialogue: str, sentiment: str, player_id: int = None, context: list = [], player_name: str = "", build=None, timeout: float = None, summary: str = None):
+    # Yields reply text fragments as Ollama produces them; errors are yielded as the usual warning text
+    reply = answer_small_talk(player_dialogue, player_id, context, player_name, build)
+    if reply is not None:
+        yield reply
+        return
+    payload = build_npc_payload(player_dialogue, sentiment, player_id, context, player_name, build, summary)
+    payload["stream"] = True
+    client = get_llm_client()
+    parts = []
+    try:
+        async for chunk in client.stream(payload, timeout=timeout):
+            token = chunk.get("response", "")
+            if token:
+                parts.append(token)
+                yield token
+            if chunk.get("done"):
+                # The final chunk carries the prompt-eval counters and the new conversation context
+                record_generation(payload, chunk, "".join(parts).strip(), player_id, player_dialogue)
+                return
+    except LLMStatusError as e:
+        yield parse_llm_response(e.response)
+    except LLMBusyError:
+        raise
     except Exception as e:
-        print(f"Unexpected error: {e}")
-        return "⚠️ Unexpected error occurred."
\ No newline at end of file
+        yield llm_error_message(e)
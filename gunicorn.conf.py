@@ -0,0 +1,36 @@
+# Multi-worker deployment:  gunicorn main:app -c gunicorn.conf.py
+#
+# SENTIMENT_SHARE=preload (default): the app and the sentiment weights are loaded once in the master
+# before forking, so workers share the weight pages copy-on-write instead of holding a copy each.
+# With SENTIMENT_BACKEND=remote the model lives in sentiment_server.py instead and nothing is preloaded.
+import os, gc
+
+bind = os.getenv("BIND", "0.0.0.0:10000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+preload_app = os.getenv("SENTIMENT_SHARE", "preload") == "preload"
+
+def when_ready(server):
+    if not preload_app:
+        return
+    import sentiment
+    sentiment.preload()
+    if os.getenv("MEMORY_RETRIEVAL", "1") == "1":
+        import memory_index
+        memory_index.get_embedder()
+    # main.py's create_all opened a pooled DB connection in the master; close it so no worker
+    # inherits (and shares) that socket
+    import database
+    database.engine.dispose()
+    # Move everything allocated so far out of the GC's reach: collections would otherwise touch
+    # (and so copy) the object headers on shared pages in every worker
+    gc.collect()
+    gc.freeze()
+
+def post_fork(server, worker):
+    # Safety net for connections the master opened after when_ready: drop the inherited pool without
+    # closing the parent's sockets, so the worker opens its own connections
+    if preload_app:
+        import database
+        database.engine.dispose(close=False)
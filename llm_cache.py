@@ -0,0 +1,93 @@
+import os, json, time, asyncio, hashlib
+from collections import OrderedDict
+
+# De-duplication of identical generations. The prompt built by build_npc_payload is deterministic, so a
+# double-submit or a client retry produces the exact same payload:
+#   - single-flight: concurrent identical payloads share one in-flight generation
+#   - reply cache (optional, LLM_REPLY_CACHE_TTL > 0): completed 200 responses are reused for a while
+# Both live on the LLM client's event loop, so their state is only touched from one thread.
+LLM_SINGLE_FLIGHT = os.getenv("LLM_SINGLE_FLIGHT", "1") == "1"
+LLM_REPLY_CACHE_SIZE = int(os.getenv("LLM_REPLY_CACHE_SIZE", "512"))
+LLM_REPLY_CACHE_TTL = float(os.getenv("LLM_REPLY_CACHE_TTL", "0"))
+
+# Transport-only fields that don't change what the model generates
+IGNORED_FIELDS = {"stream", "keep_alive"}
+
+def payload_key(payload: dict) -> str:
+    # Hash of model, system prompt, prompt, options and the reused Ollama context
+    material = {k: v for k, v in payload.items() if k not in IGNORED_FIELDS}
+    return hashlib.sha256(json.dumps(material, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+class ReplyCache:
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0 and self.max_entries > 0
+
+    def get(self, key: str):
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, value):
+        if not self.enabled:
+            return
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+class SingleFlight:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.leaders = 0
+        self.coalesced = 0
+        self._flights = {}
+
+    async def do(self, key: str, coro_fn):
+        # The first caller for a key starts the work; callers arriving while it runs await the same
+        # task. The task is shielded so one caller going away doesn't cancel it for the others.
+        if not self.enabled:
+            return await coro_fn()
+        task = self._flights.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(coro_fn())
+            self._flights[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _finished(self, key: str, task):
+        self._flights.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # marks it retrieved even if every waiter went away
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "in_flight": len(self._flights), "leaders": self.leaders, "coalesced": self.coalesced}
@@ -0,0 +1,195 @@
+import asyncio, os, json, time, threading
+import httpx
+from dotenv import load_dotenv
+from llm_scheduler import LLMScheduler, LLM_MAX_INFLIGHT, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT, LLM_BACKGROUND_MAX_INFLIGHT
+from llm_cache import ReplyCache, SingleFlight, payload_key, LLM_SINGLE_FLIGHT, LLM_REPLY_CACHE_SIZE, LLM_REPLY_CACHE_TTL
+load_dotenv()
+
+# Shared keep-alive connection pool to the Ollama server. The pool lives on a dedicated event loop
+# thread so both async handlers and sync (threadpool) endpoints reuse the same connections.
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "300"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_KEEPALIVE_SECONDS = float(os.getenv("LLM_KEEPALIVE_SECONDS", "120"))
+
+class LLMStatusError(Exception):
+    # Raised by LLMClient.stream when Ollama answers with a non-200 status; carries the read response
+    def __init__(self, response: httpx.Response):
+        super().__init__(f"LLM service returned status {response.status_code}")
+        self.response = response
+
+class SharedResponse:
+    # A response another caller already received (reply cache hit, or a generation this caller joined
+    # through single-flight). Reads go to the original; `source` says it wasn't generated for this call.
+    def __init__(self, response: httpx.Response, source: str):
+        self._response = response
+        self.source = source
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+class LLMClient:
+    def __init__(self, url: str, auth=None, max_connections: int = 20, keepalive_seconds: float = 120):
+        self.url = url
+        self.auth = auth
+        self.max_connections = max_connections
+        self.keepalive_seconds = keepalive_seconds
+        self._loop = None
+        self._client = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self.scheduler = LLMScheduler(LLM_MAX_INFLIGHT, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT, LLM_BACKGROUND_MAX_INFLIGHT)
+        self.replies = ReplyCache(LLM_REPLY_CACHE_SIZE, LLM_REPLY_CACHE_TTL)
+        self.flights = SingleFlight(LLM_SINGLE_FLIGHT)
+
+    def _ensure_loop(self):
+        if self._loop is not None:
+            return self._loop
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def run():
+                    asyncio.set_event_loop(loop)
+                    self._client = httpx.AsyncClient(
+                        auth=self.auth,
+                        limits=httpx.Limits(
+                            max_connections=self.max_connections,
+                            max_keepalive_connections=self.max_connections,
+                            keepalive_expiry=self.keepalive_seconds,
+                        ),
+                    )
+                    ready.set()
+                    loop.run_forever()
+
+                self._thread = threading.Thread(target=run, name="llm-client", daemon=True)
+                self._thread.start()
+                ready.wait()
+                self._loop = loop
+        return self._loop
+
+    def submit(self, coro):
+        # Runs a coroutine on the client's loop and returns a concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    async def _post(self, payload: dict, timeout: float, queue_timeout: float = None, background: bool = False) -> httpx.Response:
+        # Waits for a generation slot (or raises LLMBusyError), then sends the request
+        return await self.scheduler.run(
+            lambda: self._client.post(
+                self.url,
+                json=payload,
+                timeout=httpx.Timeout(timeout, connect=min(LLM_CONNECT_TIMEOUT, timeout)),
+            ),
+            queue_timeout,
+            background,
+        )
+
+    async def _generate(self, payload: dict, timeout: float, queue_timeout: float = None, background: bool = False) -> httpx.Response:
+        # Identical payloads are served from the reply cache or joined to the generation already running
+        key = payload_key(payload)
+        cached = self.replies.get(key)
+        if cached is not None:
+            print("♻️ LLM reply cache hit")
+            return SharedResponse(cached, "reply_cache")
+        led = []
+
+        async def post():
+            led.append(True)    # only runs for the caller that actually sends the request
+            response = await self._post(payload, timeout, queue_timeout, background)
+            if response.status_code == 200:
+                self.replies.put(key, response)
+            return response
+
+        response = await self.flights.do(key, post)
+        return response if led else SharedResponse(response, "coalesced")
+
+    async def generate(self, payload: dict, timeout: float = None, queue_timeout: float = None) -> httpx.Response:
+        return await asyncio.wrap_future(self.submit(self._generate(payload, timeout or LLM_TIMEOUT, queue_timeout)))
+
+    def generate_sync(self, payload: dict, timeout: float = None, queue_timeout: float = None, background: bool = False) -> httpx.Response:
+        # background=True: low-priority lane, only runs when no chat request is waiting
+        return self.submit(self._generate(payload, timeout or LLM_TIMEOUT, queue_timeout, background)).result()
+
+    def dedup_stats(self) -> dict:
+        return {"single_flight": self.flights.stats(), "reply_cache": self.replies.stats()}
+
+    async def stream(self, payload: dict, timeout: float = None, queue_timeout: float = None):
+        # Yields the parsed NDJSON chunks of a streaming generation as they arrive. The HTTP request
+        # runs on the client loop; chunks are handed over to the caller's loop through a queue.
+        timeout = timeout or LLM_TIMEOUT
+        caller_loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        finished = object()
+
+        async def pump():
+            try:
+                await self.scheduler.acquire(queue_timeout)
+            except Exception as e:
+                caller_loop.call_soon_threadsafe(chunks.put_nowait, e)
+                return
+            started = time.monotonic()
+            try:
+                async with self._client.stream(
+                    "POST",
+                    self.url,
+                    json=payload,
+                    timeout=httpx.Timeout(timeout, connect=min(LLM_CONNECT_TIMEOUT, timeout)),
+                ) as response:
+                    if response.status_code != 200:
+                        await response.aread()
+                        raise LLMStatusError(response)
+                    async for line in response.aiter_lines():
+                        if line.strip():
+                            caller_loop.call_soon_threadsafe(chunks.put_nowait, json.loads(line))
+            except Exception as e:
+                caller_loop.call_soon_threadsafe(chunks.put_nowait, e)
+            else:
+                caller_loop.call_soon_threadsafe(chunks.put_nowait, finished)
+            finally:
+                self.scheduler.release(time.monotonic() - started)
+
+        future = self.submit(pump())
+        try:
+            while True:
+                item = await chunks.get()
+                if item is finished:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Stops the upstream generation if the consumer goes away early
+            future.cancel()
+
+    def close(self):
+        if self._loop is None:
+            return
+        try:
+            self.submit(self._client.aclose()).result(timeout=5)
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_llm_client() -> LLMClient:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                llm_api_url = os.getenv("LLM_API_URL")
+                if not llm_api_url:
+                    raise ValueError("Missing environment variable: LLM_API_URL")
+                llm_user = os.getenv("LLM_API_USERNAME")
+                llm_pass = os.getenv("LLM_API_PASSWORD")
+                auth = (llm_user, llm_pass) if llm_user and llm_pass else None
+                _client = LLMClient(llm_api_url, auth, LLM_MAX_CONNECTIONS, LLM_KEEPALIVE_SECONDS)
+    return _client
+
+def close_llm_client():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
@@ -0,0 +1,141 @@
+import os, math, time, asyncio
+from collections import deque
+
+# Admission control for LLM generations. At most LLM_MAX_INFLIGHT generations run at once; up to
+# LLM_MAX_QUEUE more wait in FIFO order for at most their deadline. Anything beyond that is
+# rejected immediately with LLMBusyError so the API can answer 429 with a retry hint instead of
+# letting every player slow down together.
+# Background work (memory summary folds) has its own lane: it only gets a slot when no chat request
+# is waiting, and at most LLM_BACKGROUND_MAX_INFLIGHT slots at a time, so folds never queue ahead
+# of players or take over every slot.
+# The scheduler lives on the LLM client's event loop, so its state is only touched from one thread.
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", "2"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "32"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))
+LLM_BACKGROUND_MAX_INFLIGHT = int(os.getenv("LLM_BACKGROUND_MAX_INFLIGHT", "1"))
+
+class LLMBusyError(Exception):
+    def __init__(self, retry_after: float, reason: str = "queue_full"):
+        super().__init__(f"LLM is busy ({reason}), retry after {retry_after}s")
+        self.retry_after = retry_after
+        self.reason = reason
+
+class LLMScheduler:
+    def __init__(self, max_inflight: int = 2, max_queue: int = 32, queue_timeout: float = 30, max_background: int = 1):
+        self.max_inflight = max(1, max_inflight)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.max_background = min(max(1, max_background), self.max_inflight)
+        self.inflight = 0
+        self.background_inflight = 0
+        self._waiters = deque()
+        self._background = deque()
+        # EWMA of generation time, used for the retry hint
+        self._service_time = 5.0
+        self.stats_counters = {
+            "admitted": 0, "rejected": 0, "timed_out": 0,
+            "wait_seconds_sum": 0.0, "wait_seconds_max": 0.0,
+        }
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        # Rough time until a newly queued request would get a slot
+        return max(1, math.ceil(self._service_time * (self.queued + 1) / self.max_inflight))
+
+    def would_reject(self) -> bool:
+        return self.inflight >= self.max_inflight and self.queued >= self.max_queue
+
+    def _can_start_background(self) -> bool:
+        return not self._waiters and self.background_inflight < self.max_background
+
+    async def acquire(self, queue_timeout: float = None, background: bool = False):
+        start = time.monotonic()
+        waiters = self._background if background else self._waiters
+        if self.inflight < self.max_inflight and not waiters and (not background or self._can_start_background()):
+            self.inflight += 1
+            if background:
+                self.background_inflight += 1
+            self._admitted(0.0)
+            return
+        if len(waiters) >= self.max_queue:
+            self.stats_counters["rejected"] += 1
+            raise LLMBusyError(self.retry_after(), "queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        waiters.append(waiter)
+        timeout = self.queue_timeout if queue_timeout is None else queue_timeout
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the deadline hit; take it
+                self._admitted(time.monotonic() - start)
+                return
+            self._discard(waiters, waiter)
+            self.stats_counters["timed_out"] += 1
+            raise LLMBusyError(self.retry_after(), "queue_timeout")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(background=background)
+            else:
+                self._discard(waiters, waiter)
+            raise
+        self._admitted(time.monotonic() - start)
+
+    def release(self, service_seconds: float = None, background: bool = False):
+        if service_seconds is not None:
+            self._service_time = 0.8 * self._service_time + 0.2 * service_seconds
+        if background:
+            self.background_inflight -= 1
+        # Hand the slot straight to the next waiter (chat first); inflight stays the same
+        if self._hand_over(self._waiters):
+            return
+        if self._can_start_background() and self._hand_over(self._background):
+            self.background_inflight += 1
+            return
+        self.inflight -= 1
+
+    def _hand_over(self, waiters) -> bool:
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return True
+        return False
+
+    async def run(self, coro_fn, queue_timeout: float = None, background: bool = False):
+        await self.acquire(queue_timeout, background)
+        start = time.monotonic()
+        try:
+            return await coro_fn()
+        finally:
+            self.release(time.monotonic() - start, background)
+
+    def stats(self) -> dict:
+        counters = dict(self.stats_counters)
+        admitted = counters["admitted"]
+        return {
+            "inflight": self.inflight,
+            "queued": self.queued,
+            "max_inflight": self.max_inflight,
+            "max_queue": self.max_queue,
+            "background_inflight": self.background_inflight,
+            "background_queued": len(self._background),
+            "avg_generation_seconds": round(self._service_time, 3),
+            "avg_wait_seconds": round(counters["wait_seconds_sum"] / admitted, 4) if admitted else 0.0,
+            **counters,
+        }
+
+    def _admitted(self, waited: float):
+        self.stats_counters["admitted"] += 1
+        self.stats_counters["wait_seconds_sum"] += waited
+        self.stats_counters["wait_seconds_max"] = max(self.stats_counters["wait_seconds_max"], waited)
+
+    def _discard(self, waiters, waiter):
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            pass
@@ -1,19 +1,32 @@
-from fastapi import FastAPI, Depends, HTTPException, Request, Form, Query
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, Form, Query, BackgroundTasks, WebSocket, WebSocketDisconnect
 from sqlalchemy.orm import Session
 from database import SessionLocal, engine
-from models import Base, NPCMemory, Player, CarBuild
-from schemas import NPCMemoryCreate, NPCMemoryResponse, NPCMemoryUpdate, PlayerCreate, PlayerResponse
+from models import Base, NPCMemory, Player, CarBuild, hash_dialogue
+from schemas import NPCMemoryCreate, NPCMemoryResponse, NPCMemoryUpdate, NPCMemoryPage, PlayerCreate, PlayerResponse, ChatBatchRequest, ChatBatchResponse
 from typing import List
-from sentiment import analyze_sentiment
-from deepseek import generate_npc_response
+from sentiment import analyze_sentiment, analyze_sentiment_async, warmup, start_background_warmup, is_ready, warmup_status, sentiment_cache_stats
+from deepseek import generate_npc_response, generate_npc_response_async, stream_npc_response, reset_session_context, prompt_eval_stats, small_talk_stats
+from llm_client import close_llm_client, get_llm_client
+from llm_scheduler import LLMBusyError
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import JSONResponse, RedirectResponse, HTMLResponse
+from fastapi.responses import JSONResponse, RedirectResponse, HTMLResponse, StreamingResponse, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from fastapi.encoders import jsonable_encoder
 from turbotom import turbotom_response
-import os, json, hashlib, time, random
+from pagination import fetch_page, HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE
+from context_cache import context_cache, load_player_context, load_player_context_async, record_turn, record_build, invalidate_player
+from write_behind import NPC_WRITE_BEHIND, get_writer
+from context_budget import start_tokenizer_load, token_cache_stats
+from memory_summary import MEMORY_CONTEXT_TURNS, prompt_turns, get_summarizer, reset_summary
+from memory_index import get_memory_index, recall_turns, merge_recalled, MEMORY_RETRIEVAL
+from chat_pipeline import StageTimer, prepare_chat_turn, persist_turn, score_npc_sentiment
+from chat_pipeline import prepare_chat_batch, persist_turns, score_npc_sentiments, CHAT_BATCH_MAX_ITEMS, CHAT_BATCH_CONCURRENCY
+import metrics
+import os, json, hashlib, time, random, asyncio, threading
+from types import SimpleNamespace
 from uuid import UUID, uuid4
 
 templates = Jinja2Templates(directory="templates") #Template directory setup
@@ -35,11 +48,59 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request duration and SQL statements per request, per route (see /metrics)
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.instrument_engine(engine)
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+# LLM admission control rejected the request: tell the client when to retry
+@app.exception_handler(LLMBusyError)
+def llm_busy_handler(request: Request, exc: LLMBusyError):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "NPC is busy, please retry shortly.", "reason": exc.reason, "retry_after": exc.retry_after},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
 # Create database tables
 Base.metadata.create_all(bind=engine)
 
+# Sentiment model warmup at startup: "eager" blocks startup until the model is hot,
+# "background" loads it in a thread while the app already serves requests, "off" loads on first use
+SENTIMENT_WARMUP = os.getenv("SENTIMENT_WARMUP", "background").lower()
+# WebSocket chat: seconds to send credentials after connecting, and to wait for the next message (0 = no limit)
+WS_AUTH_TIMEOUT = float(os.getenv("WS_AUTH_TIMEOUT", "10"))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "0"))
+
+@app.on_event("startup")
+def warm_up_sentiment():
+    if SENTIMENT_WARMUP == "eager":
+        warmup()
+    elif SENTIMENT_WARMUP == "background":
+        start_background_warmup()
+
+# Tokenizer for prompt budgeting; loaded off the request path so the first chat turn doesn't pay for it
+@app.on_event("startup")
+def load_tokenizer():
+    start_tokenizer_load()
+
+# Embedding model for semantic recall, also loaded off the request path
+@app.on_event("startup")
+def load_memory_embedder():
+    if MEMORY_RETRIEVAL:
+        from memory_index import get_embedder
+        threading.Thread(target=get_embedder, name="embedder-load", daemon=True).start()
+
+@app.on_event("shutdown")
+def close_llm_connections():
+    close_llm_client()
+
+@app.on_event("shutdown")
+def flush_write_behind():
+    if NPC_WRITE_BEHIND:
+        get_writer().close()
+
 class ChatRequest(BaseModel):
     player_id: int
     npc_id: int
@@ -53,6 +114,11 @@ def get_db():
     finally:
         db.close()
 
+# Read-your-writes for write-behind mode: wait until the player's queued rows are committed
+def wait_for_pending_writes(player_id: int):
+    if NPC_WRITE_BEHIND and get_writer().has_pending(player_id):
+        get_writer().wait_for_player(player_id)
+
 #  Root route   
 @app.get("/", response_class=HTMLResponse)
 def login_page_redirect(request: Request):
@@ -67,25 +133,37 @@ def cover_page(request: Request, player_id: int = Query(...), db: Session = Depe
 
 #  Store a new NPC interaction with duplicate check
 @app.post("/store_interaction/", response_model=NPCMemoryResponse, description="Player sends dialogue only. Sentiment is auto-analyzed and NPC reply is generated.", tags=["Create"])
-def store_interaction(data: NPCMemoryCreate, db: Session = Depends(get_db)):
+def store_interaction(data: NPCMemoryCreate, response: Response, db: Session = Depends(get_db)):
+    timer = StageTimer("store_interaction")
+    wait_for_pending_writes(data.player_id)
     # Check for duplicate entry
-    existing_entry = db.query(NPCMemory).filter(
-        NPCMemory.player_id == data.player_id,
-        NPCMemory.npc_id == data.npc_id,
-        NPCMemory.dialogue == data.dialogue
-    ).first()
+    with timer.stage("dup_check"):
+        existing_entry = db.query(NPCMemory).filter(
+            NPCMemory.player_id == data.player_id,
+            NPCMemory.npc_id == data.npc_id,
+            NPCMemory.dialogue_hash == hash_dialogue(data.dialogue),
+            NPCMemory.dialogue == data.dialogue
+        ).first()
 
     if existing_entry:
         raise HTTPException(status_code=400, detail="This interaction already exists.")
 
     # Analyze player sentiment
-    player_sentiment = analyze_sentiment(data.dialogue)
-
-    # Generate NPC response
-    npc_reply = generate_npc_response(data.dialogue, player_sentiment)
+    with timer.stage("sentiment"):
+        player_sentiment = analyze_sentiment(data.dialogue)
+
+    # Generate NPC response (addressing the player by name, with their current build)
+    with timer.stage("context"):
+        player_ctx = load_player_context(db, data.player_id, turns_needed=0)
+    with timer.stage("llm"):
+        npc_reply = generate_npc_response(
+            data.dialogue, player_sentiment,
+            player_name=player_ctx.player_name if player_ctx else "", build=player_ctx.build if player_ctx else None
+        )
 
     # Analyze NPC sentiment
-    npc_sentiment = analyze_sentiment(npc_reply)
+    with timer.stage("npc_sentiment"):
+        npc_sentiment = analyze_sentiment(npc_reply)
 
     # Create the object manually to inject the predicted sentiment  
     npc_interaction = NPCMemory(
@@ -98,25 +176,47 @@ def store_interaction(data: NPCMemoryCreate, db: Session = Depends(get_db)):
     )
     db.add(npc_interaction)
     try:
-        db.commit()
-        db.refresh(npc_interaction)
+        with timer.stage("db"):
+            db.commit()
+            db.refresh(npc_interaction)
     except Exception as e:
         db.rollback()
         print("DB commit error (store_interaction): ", e)
         raise HTTPException(status_code=500, detail="Database connection issue, consider a retry.")
+    record_turn(data.player_id, data.npc_id, data.dialogue, player_sentiment, npc_reply, npc_sentiment,
+                id=npc_interaction.id, timestamp=npc_interaction.timestamp)
+    get_summarizer().schedule(data.player_id)
+    response.headers["Server-Timing"] = timer.server_timing()
     return npc_interaction
 
-#  Retrieve past interactions with error handling
-@app.get("/get_interactions/{player_id}/{npc_id}", response_model=List[NPCMemoryResponse], tags=["Retrieval"])
-def get_interactions(player_id: int, npc_id: int, db: Session = Depends(get_db)):
-    interactions = db.query(NPCMemory).filter(
+#  Retrieve past interactions with error handling (newest first, one page at a time)
+@app.get("/get_interactions/{player_id}/{npc_id}", response_model=List[NPCMemoryResponse], description="Returns one page of interactions, newest first. Pass the X-Next-Cursor response header back as `cursor` to get older ones.", tags=["Retrieval"])
+def get_interactions(
+    player_id: int,
+    npc_id: int,
+    response: Response,
+    cursor: str = Query(default=None),
+    limit: int = Query(default=HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    db: Session = Depends(get_db)
+):
+    timer = StageTimer("get_interactions")
+    wait_for_pending_writes(player_id)
+    query = db.query(NPCMemory).filter(
         NPCMemory.player_id == player_id,
         NPCMemory.npc_id == npc_id
-    ).order_by(NPCMemory.timestamp.desc()).all()
+    )
+    try:
+        with timer.stage("db"):
+            interactions, next_cursor = fetch_page(query, cursor, limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
 
-    if not interactions:
+    if not interactions and not cursor:
         raise HTTPException(status_code=404, detail="No interactions found for this player and NPC.")
 
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    response.headers["Server-Timing"] = timer.server_timing()
     return interactions
 
 #  Update an NPC interaction
@@ -129,13 +229,19 @@ def update_interaction(id: int, data: NPCMemoryUpdate, db: Session = Depends(get
 
     # Always update dialogue
     npc_interaction.dialogue = data.dialogue
+    reset_summary(db, npc_interaction.player_id, id)
 
     # Analyze or accept player sentiment
     player_sentiment = analyze_sentiment(data.dialogue)
     npc_interaction.sentiment = player_sentiment
 
     # Generate NPC response via Deepseek
-    npc_reply = generate_npc_response(data.dialogue, player_sentiment)
+    player = db.query(Player).filter(Player.id == npc_interaction.player_id).first()
+    npc_reply = generate_npc_response(
+        data.dialogue, player_sentiment,
+        player_name=(player.display_name or player.name) if player else "",
+        build=get_latest_build(npc_interaction.player_id, db)
+    )
     npc_interaction.npc_reply = npc_reply
 
     # Analyze NPC sentiment
@@ -143,6 +249,13 @@ def update_interaction(id: int, data: NPCMemoryUpdate, db: Session = Depends(get
 
     db.commit()
     db.refresh(npc_interaction)
+    # The LLM's cached conversation and the cached context no longer match the stored history. Dropped
+    # only after the commit, so a chat running meanwhile can't reload and re-cache the old row.
+    reset_session_context(npc_interaction.player_id)
+    invalidate_player(npc_interaction.player_id)
+    # Rebuilt by catch-up from committed rows; resetting earlier could re-embed the pre-edit dialogue
+    get_memory_index().reset(npc_interaction.player_id)
+    get_summarizer().schedule(npc_interaction.player_id)
     return npc_interaction
 
 #  Delete an NPC interaction
@@ -157,7 +270,12 @@ def delete_interaction(id: int, db: Session = Depends(get_db)):
     deleted_data = NPCMemoryResponse.model_validate(npc_interaction)
 
     db.delete(npc_interaction)
+    reset_summary(db, deleted_data.player_id, id)
     db.commit()
+    reset_session_context(deleted_data.player_id)
+    invalidate_player(deleted_data.player_id)
+    get_summarizer().schedule(deleted_data.player_id)
+    get_memory_index().reset(deleted_data.player_id)
     return deleted_data
 
 # Check health status
@@ -165,6 +283,62 @@ def delete_interaction(id: int, db: Session = Depends(get_db)):
 def health_check():
     return {"status": "OK"}
 
+# Runtime counters for the caches, the small-talk fast path and the LLM queue
+@app.get("/stats", tags=["System"])
+def runtime_stats():
+    return {
+        "llm_queue": get_llm_client().scheduler.stats(),
+        "llm_dedup": get_llm_client().dedup_stats(),
+        "prompt_eval": prompt_eval_stats(),
+        "small_talk": small_talk_stats(),
+        "sentiment_cache": sentiment_cache_stats(),
+        "context_cache": context_cache.stats(),
+        "token_counts": token_cache_stats(),
+        "memory_summary": get_summarizer().stats(),
+        "memory_index": get_memory_index().stats(),
+        "write_behind": get_writer().stats() if NPC_WRITE_BEHIND else None,
+    }
+
+# Cache hit/miss counters and LLM queue state, read from the same stats() functions as /stats at scrape time
+def cache_counters(field: str):
+    def collect():
+        dedup = get_llm_client().dedup_stats()
+        caches = {
+            "sentiment": sentiment_cache_stats(),
+            "context": context_cache.stats(),
+            "token_counts": token_cache_stats(),
+            "llm_reply": dedup["reply_cache"],
+            "small_talk": small_talk_stats(),
+        }
+        return [((name,), stats[field]) for name, stats in caches.items()]
+    return collect
+
+def llm_queue_values(fields: tuple):
+    def collect():
+        stats = get_llm_client().scheduler.stats()
+        return [((field,), stats[field]) for field in fields]
+    return collect
+
+metrics.callback("npc_cache_hits_total", "Cache hits (small_talk: messages answered from templates).", "counter", ("cache",), cache_counters("hits"))
+metrics.callback("npc_cache_misses_total", "Cache misses (small_talk: messages sent to the LLM).", "counter", ("cache",), cache_counters("misses"))
+metrics.callback("npc_llm_queue", "LLM generations running and waiting for a slot.", "gauge", ("state",), llm_queue_values(("inflight", "queued")))
+metrics.callback("npc_llm_admissions_total", "LLM admission decisions.", "counter", ("outcome",), llm_queue_values(("admitted", "rejected", "timed_out")))
+metrics.callback("npc_llm_coalesced_total", "Generations that joined an identical one already in flight.", "counter", (),
+                 lambda: [((), get_llm_client().dedup_stats()["single_flight"]["coalesced"])])
+
+# Prometheus text format: stage/request latency histograms, LLM token counts, SQL per request, cache counters
+@app.get("/metrics", tags=["System"], response_class=PlainTextResponse)
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Readiness for chat traffic: 503 until the sentiment model is loaded and warmed up. With
+# SENTIMENT_WARMUP=off nothing loads it before the first request, so the app is ready right away.
+@app.get("/ready", tags=["System"])
+def readiness_check():
+    if SENTIMENT_WARMUP != "off" and not is_ready():
+        return JSONResponse(status_code=503, content={"status": "warming_up", "sentiment": warmup_status()})
+    return {"status": "ready", "sentiment": warmup_status()}
+
 # Create a new player
 @app.post("/create_player", response_model=PlayerResponse, tags=["Players"])
 def create_player(player: PlayerCreate, db: Session = Depends(get_db)):
@@ -185,21 +359,24 @@ def create_player(player: PlayerCreate, db: Session = Depends(get_db)):
 def get_players(db: Session = Depends(get_db)):
     return db.query(Player).all()
 
+def chat_history_page(player_id: int, db: Session, cursor: str = None, limit: int = HISTORY_PAGE_SIZE):
+    # One page of the player's chat, returned oldest-first for rendering
+    wait_for_pending_writes(player_id)
+    query = db.query(NPCMemory).filter(NPCMemory.player_id == player_id)
+    rows, next_cursor = fetch_page(query, cursor, limit)
+    return list(reversed(rows)), next_cursor
+
 @app.get("/chat", response_class=HTMLResponse)
 def get_chat(request: Request, player_id: int = Query(default=None), db: Session = Depends(get_db)):
     players = db.query(Player).all()
     chat_history = []
+    older_cursor = None
 
     latest_build = None
     intro_message = ""
 
     if player_id:
-        chat_history = (
-            db.query(NPCMemory)
-            .filter(NPCMemory.player_id == player_id)
-            .order_by(NPCMemory.timestamp.asc())
-            .all()
-        )
+        chat_history, older_cursor = chat_history_page(player_id, db)
         latest_build = get_latest_build(player_id, db)
 
     if latest_build:
@@ -210,9 +387,24 @@ def get_chat(request: Request, player_id: int = Query(default=None), db: Session
         "players": players,
         "selected_player_id": player_id,
         "chat_history": chat_history,
+        "older_cursor": older_cursor,
         "intro_message": intro_message
     })
 
+# "Load older" for the chat page: the page before `cursor`, oldest first
+@app.get("/chat/history", response_model=NPCMemoryPage, tags=["Retrieval"])
+def get_chat_history(
+    player_id: int = Query(...),
+    cursor: str = Query(default=None),
+    limit: int = Query(default=HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    db: Session = Depends(get_db)
+):
+    try:
+        items, next_cursor = chat_history_page(player_id, db, cursor, limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    return {"items": items, "next_cursor": next_cursor}
+
 @app.post("/chat", response_class=HTMLResponse)
 def post_chat(
     request: Request,
@@ -221,21 +413,25 @@ def post_chat(
     dialogue: str = Form(...),
     db: Session = Depends(get_db)
 ):
+    timer = StageTimer("chat")
     players = db.query(Player).all()
 
-    #Fetches last 3 interactions for player
-    history = (
-        db.query(NPCMemory)
-        .filter(NPCMemory.player_id == player_id)
-        .order_by(NPCMemory.timestamp.desc())
-        .limit(1)
-        .all()
-    )
-    context = list(reversed(history)) #reversing from old to new to fetch the last 2
-
-    sentiment = analyze_sentiment(dialogue)
-    player_name = db.query(Player).filter(Player.id == player_id).first().name
-    npc_reply = generate_npc_response(dialogue, sentiment, player_id, context, player_name)
+    #Fetches the recent interactions, memory summary, player name and build (from the context cache when warm)
+    wait_for_pending_writes(player_id)
+    with timer.stage("context"):
+        player_ctx = load_player_context(db, player_id, turns_needed=MEMORY_CONTEXT_TURNS)
+    if not player_ctx:
+        raise HTTPException(status_code=404, detail="Player not found.")
+    recent = prompt_turns(player_ctx)
+    with timer.stage("recall"):
+        context = merge_recalled(recall_turns(player_id, dialogue, {t.id for t in recent}), recent)
+
+    with timer.stage("sentiment"):
+        sentiment = analyze_sentiment(dialogue)
+    with timer.stage("llm"):
+        npc_reply = generate_npc_response(dialogue, sentiment, player_id, context, player_ctx.player_name, build=player_ctx.build, summary=player_ctx.summary)
+    with timer.stage("npc_sentiment"):
+        npc_sentiment = analyze_sentiment(npc_reply)
 
     memory = NPCMemory(
         player_id = player_id,
@@ -243,23 +439,23 @@ def post_chat(
         dialogue = dialogue,
         sentiment = sentiment,
         npc_reply = npc_reply,
-        npc_sentiment = analyze_sentiment(npc_reply)
+        npc_sentiment = npc_sentiment
     )
 
     db.add(memory)
     try:
-        db.commit()
+        with timer.stage("db"):
+            db.commit()
+            db.refresh(memory)
     except Exception as e:
         db.rollback()
         print("DB commit error (post_chat): ", e)
         raise HTTPException(status_code=500, detail="Database connection issue, please retry")
+    record_turn(player_id, 1, dialogue, sentiment, npc_reply, npc_sentiment, id=memory.id, timestamp=memory.timestamp)
+    get_summarizer().schedule(player_id)
 
-    chat_history = (
-        db.query(NPCMemory)
-        .filter(NPCMemory.player_id == player_id)
-        .order_by(NPCMemory.timestamp.asc())
-        .all()
-    )
+    with timer.stage("history"):
+        chat_history, older_cursor = chat_history_page(player_id, db)
 
     return templates.TemplateResponse("chat.html", {
         "request": request,
@@ -267,65 +463,189 @@ def post_chat(
         "npc_reply": npc_reply,
         "last_dialogue": dialogue,
         "selected_player_id": player_id,
-        "chat_history": chat_history
-    })
+        "chat_history": chat_history,
+        "older_cursor": older_cursor
+    }, headers={"Server-Timing": timer.server_timing()})
 
 @app.post("/chat_api")
 async def chat_api(
     request: Request,
+    background_tasks: BackgroundTasks,
     player_id: int = Form(...),
     npc_id: int = Form(1),
-    dialogue: str = Form(...),
-    db: Session = Depends(get_db)
+    dialogue: str = Form(...)
 ):
-    history = (
-        db.query(NPCMemory)
-        .filter(NPCMemory.player_id == player_id)  
-        .order_by(NPCMemory.timestamp.desc())
-        .limit(2)
-        .all()
-    )
-    context = list(reversed(history))
-
-    start = time.time()
-    sentiment = analyze_sentiment(dialogue)
-    print("Sentiment analysis took:", round(time.time() - start, 2), "s")
-    player_obj = db.query(Player).filter(Player.id == player_id).first()
-    player_name = player_obj.display_name or player_obj.name
-    build = get_latest_build(player_id, db)
-    llm_start = time.time()
-    npc_reply = generate_npc_response(dialogue, sentiment, player_id, context, player_name, build=build)
-    llm_duration = round(time.time() - llm_start, 2)
-    print(f"⏱️ LLM generation took: {llm_duration}s")
-    
-    commit_start = time.time()
-    memory = NPCMemory(
-        player_id=player_id,
-        npc_id=1,
-        dialogue=dialogue,
-        sentiment=sentiment,
-        npc_reply=npc_reply,
-        npc_sentiment=analyze_sentiment(npc_reply)
+    timer = StageTimer("chat_api")
+    player_ctx, sentiment, recalled = await prepare_chat_turn(player_id, dialogue, timer, MEMORY_CONTEXT_TURNS, wait_for_pending_writes)
+    if not player_ctx:
+        raise HTTPException(status_code=404, detail="Player not found.")
+    context = merge_recalled(recalled, prompt_turns(player_ctx))
+
+    npc_reply = await timer.run("llm", generate_npc_response_async(
+        dialogue, sentiment, player_id, context, player_ctx.player_name, build=player_ctx.build, summary=player_ctx.summary
+    ))
+
+    # Write-behind: reply now, the background writer scores NPC sentiment and inserts the row
+    if NPC_WRITE_BEHIND and get_writer().enqueue(player_id, 1, dialogue, sentiment, npc_reply):
+        record_turn(player_id, 1, dialogue, sentiment, npc_reply)
+    else:
+        try:
+            memory_id = await timer.run("db", run_in_threadpool(persist_turn, player_id, 1, dialogue, sentiment, npc_reply))
+        except Exception as e:
+            print("DB commit error (chat_api): ", e)
+            raise HTTPException(status_code=500, detail="Database issue")
+        record_turn(player_id, 1, dialogue, sentiment, npc_reply, id=memory_id)
+        # NPC sentiment isn't part of the reply, so it is scored after the response goes out
+        background_tasks.add_task(score_npc_sentiment, memory_id, npc_reply)
+    get_summarizer().schedule(player_id)
+
+    timer.log("chat_api")
+    return JSONResponse(
+        content={
+            "player_dialogue": dialogue,
+            "npc_reply": npc_reply["response"] if isinstance(npc_reply, dict) else str(npc_reply)
+        },
+        headers={"Server-Timing": timer.server_timing()}
     )
-    db.add(memory)
-    db.commit()
-    print("🗃️ DB commit took:", round(time.time() - commit_start, 2), "s")
-
-    try:
-        db_commit_start = time.time()
-        db_duration = round(time.time() - db_commit_start, 2)
-        print(f"🗃️ DB commit took: {db_duration}s")
-
-    except Exception as e:
-        db.rollback()
-        print("DB commit error (chat_api): ", e)
-        raise HTTPException(status_code=500, detail="Database issue")
 
-    return JSONResponse(content={
-        "player_dialogue": dialogue,
-        "npc_reply": npc_reply["response"] if isinstance(npc_reply, dict) else str(npc_reply)
+# Many players' messages in one request (e.g. relayed by the game server each tick). Sentiment is scored in
+# one batched pass, contexts are read with set-based queries, replies are generated at most
+# CHAT_BATCH_CONCURRENCY at a time and all turns are inserted together. Each item gets its own status.
+@app.post("/chat_batch", response_model=ChatBatchResponse)
+async def chat_batch(batch: ChatBatchRequest, response: Response, background_tasks: BackgroundTasks):
+    items = batch.items
+    if len(items) > CHAT_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {CHAT_BATCH_MAX_ITEMS} items per batch.")
+    timer = StageTimer("chat_batch")
+    contexts, sentiments, recalled = await prepare_chat_batch(items, timer, MEMORY_CONTEXT_TURNS, wait_for_pending_writes)
+
+    results = [
+        {"player_id": item.player_id, "npc_id": item.npc_id, "status": "ok", "sentiment": sentiment}
+        for item, sentiment in zip(items, sentiments)
+    ]
+    by_player = {}
+    for i, item in enumerate(items):
+        if item.player_id in contexts:
+            by_player.setdefault(item.player_id, []).append(i)
+        else:
+            results[i].update(status="not_found", detail="Player not found.")
+
+    limit = asyncio.Semaphore(max(1, CHAT_BATCH_CONCURRENCY))
+
+    async def reply_player(player_id: int, indexes: list):
+        # A player's own messages are answered in order, each seeing the previous reply, so the
+        # Ollama session context and the history stay consistent; different players run concurrently
+        player_ctx = contexts[player_id]
+        turns = prompt_turns(player_ctx)
+        for i in indexes:
+            item = items[i]
+            context = merge_recalled(recalled[i], turns[-MEMORY_CONTEXT_TURNS:] if MEMORY_CONTEXT_TURNS > 0 else [])
+            try:
+                async with limit:
+                    npc_reply = await generate_npc_response_async(
+                        item.dialogue, sentiments[i], player_id, context, player_ctx.player_name,
+                        build=player_ctx.build, summary=player_ctx.summary
+                    )
+            except LLMBusyError as e:
+                results[i].update(status="busy", retry_after=e.retry_after, detail="NPC is busy, please retry shortly.")
+                continue
+            except Exception as e:
+                # One failed item must not fail the batch; the others are still answered and stored
+                print(f"chat_batch reply error (player {player_id}): ", e)
+                results[i].update(status="error", detail="Could not generate a reply.")
+                continue
+            npc_reply = npc_reply["response"] if isinstance(npc_reply, dict) else str(npc_reply)
+            results[i]["npc_reply"] = npc_reply
+            turns.append(SimpleNamespace(id=None, dialogue=item.dialogue, npc_reply=npc_reply))
+
+    await timer.run("llm", asyncio.gather(*(reply_player(player_id, indexes) for player_id, indexes in by_player.items())))
+
+    answered = [i for i, result in enumerate(results) if result["status"] == "ok"]
+    rows = [
+        {"player_id": items[i].player_id, "npc_id": items[i].npc_id, "dialogue": items[i].dialogue,
+         "sentiment": sentiments[i], "npc_reply": results[i]["npc_reply"]}
+        for i in answered
+    ]
+    if rows:
+        try:
+            ids = await timer.run("db", run_in_threadpool(persist_turns, rows))
+        except Exception as e:
+            print("DB commit error (chat_batch): ", e)
+            for i in answered:
+                results[i].update(status="error", detail="Database issue")
+        else:
+            for i, memory_id, row in zip(answered, ids, rows):
+                results[i]["id"] = memory_id
+                record_turn(row["player_id"], row["npc_id"], row["dialogue"], row["sentiment"], row["npc_reply"], id=memory_id)
+            for player_id in {row["player_id"] for row in rows}:
+                get_summarizer().schedule(player_id)
+            background_tasks.add_task(score_npc_sentiments, [(memory_id, row["npc_reply"]) for memory_id, row in zip(ids, rows)])
+
+    timer.log(f"chat_batch ({len(items)} items)")
+    response.headers["Server-Timing"] = timer.server_timing()
+    return {"results": results}
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Streams the NPC reply token by token as Server-Sent Events; the row is persisted once the stream completes
+@app.post("/chat_stream")
+async def chat_stream(
+    request: Request,
+    player_id: int = Form(...),
+    npc_id: int = Form(1),
+    dialogue: str = Form(...)
+):
+    # Once streaming starts a 429 is no longer possible, so reject up front when the queue is already full
+    scheduler = get_llm_client().scheduler
+    if scheduler.would_reject():
+        raise LLMBusyError(scheduler.retry_after(), "queue_full")
+
+    timer = StageTimer("chat_stream")
+    player_ctx, sentiment, recalled = await prepare_chat_turn(player_id, dialogue, timer, MEMORY_CONTEXT_TURNS, wait_for_pending_writes)
+    if not player_ctx:
+        raise HTTPException(status_code=404, detail="Player not found.")
+    context = merge_recalled(recalled, prompt_turns(player_ctx))
+
+    async def events():
+        start = time.time()
+        first_token_at = None
+        parts = []
+        try:
+            async for token in stream_npc_response(dialogue, sentiment, player_id, context, player_ctx.player_name, build=player_ctx.build, summary=player_ctx.summary):
+                if first_token_at is None:
+                    first_token_at = time.time()
+                    print(f"⏱️ Time to first token: {round(first_token_at - start, 2)}s")
+                parts.append(token)
+                yield sse_event("token", {"token": token})
+        except LLMBusyError as e:
+            yield sse_event("busy", {"detail": "NPC is busy, please retry shortly.", "retry_after": e.retry_after})
+            return
+
+        npc_reply = "".join(parts).strip()
+        print(f"⏱️ LLM stream took: {round(time.time() - start, 2)}s")
+        try:
+            npc_sentiment = await analyze_sentiment_async(npc_reply)
+            memory_id = await run_in_threadpool(persist_turn, player_id, 1, dialogue, sentiment, npc_reply, npc_sentiment)
+        except Exception as e:
+            print("DB commit error (chat_stream): ", e)
+            yield sse_event("error", {"detail": "Database issue"})
+            return
+        record_turn(player_id, 1, dialogue, sentiment, npc_reply, npc_sentiment, id=memory_id)
+        get_summarizer().schedule(player_id)
+        yield sse_event("done", {
+            "id": memory_id,
+            "player_dialogue": dialogue,
+            "npc_reply": npc_reply,
+            "sentiment": sentiment,
+            "npc_sentiment": npc_sentiment
         })
-    
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Server-Timing": timer.server_timing()}
+    )
 
 @app.get("/create_player_form", response_class=HTMLResponse)
 def player_form(request: Request):
@@ -369,10 +689,12 @@ async def chat_api_static(
     dialogue: str = Form(...),
     db : Session = Depends(get_db)
 ):
-    response = turbotom_response(dialogue, player_id, db)
+    timer = StageTimer("chat_api_static")
+    response = await timer.run("state", run_in_threadpool(turbotom_response, dialogue, player_id, db))
     return JSONResponse(content={
         "player_dialogue": dialogue,
-        "npc_reply": response}
+        "npc_reply": response},
+        headers={"Server-Timing": timer.server_timing()}
     )
 
 
@@ -413,6 +735,7 @@ async def save_car_build(
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail="Database error while saving build.")
+    record_build(player_id, build)
 
     return {"status": "success", "message": "Build saved successfully!"}
 
@@ -444,17 +767,138 @@ def login_page(request: Request):
 def evaluation_page(request: Request):
     return templates.TemplateResponse("evaluation.html", {"request": request})
 
+# UUID/PIN check shared by /verify_player and the WebSocket chat; raises ValueError for a malformed UUID
+def authenticate_player(db: Session, uuid: str, pin: str):
+    UUID(uuid)
+    hashed_pin = hashlib.sha256(pin.encode()).hexdigest()
+    return db.query(Player).filter(Player.name == uuid, Player.role == hashed_pin).first()
+
 @app.get("/verify_player")
 def verify_player(uuid: str, pin: str, db: Session = Depends(get_db)):
     try:
-        UUID(uuid)
+        player = authenticate_player(db, uuid, pin)
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid UUID format")
 
-    hashed_pin = hashlib.sha256(pin.encode()).hexdigest()
-    player = db.query(Player).filter(Player.name == uuid, Player.role == hashed_pin).first()
-
     if not player:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
     return {"player_id": player.id}
+
+def authenticate_player_id(uuid: str, pin: str):
+    # Short-lived session: a WebSocket connection holds no DB connection while it is open
+    db = SessionLocal()
+    try:
+        player = authenticate_player(db, str(uuid), str(pin))
+        return player.id if player else None
+    except ValueError:
+        return None
+    finally:
+        db.close()
+
+# Persistent chat session. The client authenticates once with its first message {"uuid", "pin"}, then
+# sends {"dialogue", "stream"} messages; the server answers each with optional "token" messages and a
+# final "reply" (or "busy" / "error"). The player's context stays pinned in the context cache while
+# the socket is open, so turns don't go back to the DB for the player, build or history, and an idle
+# connection holds nothing but the socket.
+@app.websocket("/ws/chat")
+async def ws_chat(websocket: WebSocket):
+    await websocket.accept()
+    try:
+        credentials = await asyncio.wait_for(websocket.receive_json(), WS_AUTH_TIMEOUT)
+        player_id = await run_in_threadpool(authenticate_player_id, credentials.get("uuid", ""), credentials.get("pin", ""))
+    except (asyncio.TimeoutError, ValueError, AttributeError):
+        player_id = None
+    except WebSocketDisconnect:
+        return
+    if player_id is None:
+        await websocket.send_json({"type": "error", "detail": "Unauthorized"})
+        await websocket.close(code=1008)
+        return
+
+    context_cache.pin(player_id)
+    try:
+        player_ctx = await load_player_context_async(SessionLocal, player_id, MEMORY_CONTEXT_TURNS, wait_for_pending_writes)
+        if not player_ctx:
+            await websocket.send_json({"type": "error", "detail": "Player not found."})
+            await websocket.close(code=1008)
+            return
+        await websocket.send_json({"type": "ready", "player_id": player_id, "player_name": player_ctx.player_name})
+
+        while True:
+            try:
+                message = await asyncio.wait_for(websocket.receive_json(), WS_IDLE_TIMEOUT or None)
+            except asyncio.TimeoutError:
+                await websocket.close(code=1000, reason="idle")
+                return
+            except ValueError:
+                await websocket.send_json({"type": "error", "detail": "Messages must be JSON."})
+                continue
+            dialogue = str(message.get("dialogue") or "").strip() if isinstance(message, dict) else ""
+            if not dialogue:
+                await websocket.send_json({"type": "error", "detail": "Missing dialogue."})
+                continue
+            try:
+                await ws_chat_turn(websocket, player_id, dialogue, bool(message.get("stream")))
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                # A failed turn is reported to the client; the connection stays open for the next message
+                print(f"ws_chat turn error (player {player_id}): ", e)
+                await websocket.send_json({"type": "error", "detail": "Could not answer that message, please try again."})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        context_cache.unpin(player_id)
+
+async def ws_chat_turn(websocket: WebSocket, player_id: int, dialogue: str, stream: bool):
+    scheduler = get_llm_client().scheduler
+    if scheduler.would_reject():
+        await websocket.send_json({"type": "busy", "detail": "NPC is busy, please retry shortly.", "retry_after": scheduler.retry_after()})
+        return
+
+    timer = StageTimer("ws_chat")
+    # A cache hit while the connection's entry is pinned; reloaded only after invalidate_player (edits)
+    player_ctx, sentiment, recalled = await prepare_chat_turn(player_id, dialogue, timer, MEMORY_CONTEXT_TURNS, wait_for_pending_writes)
+    if not player_ctx:
+        await websocket.send_json({"type": "error", "detail": "Player not found."})
+        return
+    context = merge_recalled(recalled, prompt_turns(player_ctx))
+
+    try:
+        if stream:
+            parts = []
+            async def pump():
+                async for token in stream_npc_response(dialogue, sentiment, player_id, context, player_ctx.player_name, build=player_ctx.build, summary=player_ctx.summary):
+                    parts.append(token)
+                    await websocket.send_json({"type": "token", "token": token})
+            await timer.run("llm", pump())
+            npc_reply = "".join(parts).strip()
+        else:
+            npc_reply = await timer.run("llm", generate_npc_response_async(
+                dialogue, sentiment, player_id, context, player_ctx.player_name, build=player_ctx.build, summary=player_ctx.summary
+            ))
+            npc_reply = npc_reply["response"] if isinstance(npc_reply, dict) else str(npc_reply)
+    except LLMBusyError as e:
+        await websocket.send_json({"type": "busy", "detail": "NPC is busy, please retry shortly.", "retry_after": e.retry_after})
+        return
+
+    try:
+        npc_sentiment = await timer.run("npc_sentiment", analyze_sentiment_async(npc_reply))
+        memory_id = await timer.run("db", run_in_threadpool(persist_turn, player_id, 1, dialogue, sentiment, npc_reply, npc_sentiment))
+    except Exception as e:
+        print("DB commit error (ws_chat): ", e)
+        await websocket.send_json({"type": "error", "detail": "Database issue"})
+        return
+    record_turn(player_id, 1, dialogue, sentiment, npc_reply, npc_sentiment, id=memory_id)
+    get_summarizer().schedule(player_id)
+    timer.log("ws_chat")
+    await websocket.send_json({
+        "type": "reply",
+        "id": memory_id,
+        "player_dialogue": dialogue,
+        "npc_reply": npc_reply,
+        "sentiment": sentiment,
+        "npc_sentiment": npc_sentiment,
+        "server_timing": timer.server_timing()
+    })
@@ -0,0 +1,404 @@
+from collections import OrderedDict
+import numpy as np
+import os, json, time, queue, asyncio, threading
+from models import NPCMemory
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, fine for a single dev server
+    fcntl = None
+
+# Semantic recall over a player's past turns: every NPCMemory turn is embedded with a small local
+# sentence model, and each chat turn retrieves the K past turns closest to the new dialogue (cosine
+# similarity, one matrix-vector product over the player's vectors).
+#
+# On disk each player is one append-only file of fixed-size records (int64 turn id + float32 vector),
+# so adding a turn is a single append and loading is a single read. The file is shared by all worker
+# processes: appends take an exclusive flock and first read what other processes appended, and every
+# search picks up new records (or a file replaced by a reset) before scoring. New turns are picked up
+# by a background worker that embeds the stored turns missing from the file, which covers the first
+# backfill, the regular insert paths and write-behind rows alike. The first catch-up after a player is
+# loaded or reset compares every stored id; later ones only look at ids near or above the newest
+# indexed one, so a chat turn costs O(new turns) rather than O(history).
+MEMORY_RETRIEVAL = os.getenv("MEMORY_RETRIEVAL", "1") == "1"
+MEMORY_EMBED_MODEL = os.getenv("MEMORY_EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+MEMORY_INDEX_DIR = os.getenv("MEMORY_INDEX_DIR", "memory_index")
+MEMORY_RETRIEVAL_K = int(os.getenv("MEMORY_RETRIEVAL_K", "3"))
+MEMORY_RETRIEVAL_MIN_SCORE = float(os.getenv("MEMORY_RETRIEVAL_MIN_SCORE", "0.35"))
+MEMORY_INDEX_PLAYERS = int(os.getenv("MEMORY_INDEX_PLAYERS", "256"))   # player indexes kept in RAM
+MEMORY_EMBED_BATCH = 64
+# Incremental catch-ups also re-check this many ids below the newest indexed one: ids are assigned at
+# insert, so a concurrent transaction (or write-behind batch) can commit a lower id after a higher one
+MEMORY_INDEX_LOOKBACK = 1000
+
+class Embedder:
+    def __init__(self, model_name: str = MEMORY_EMBED_MODEL):
+        import torch
+        from transformers import AutoTokenizer, AutoModel
+
+        self.model_name = model_name
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name)
+        self.model.eval()
+        self.dim = self.model.config.hidden_size
+        self._lock = threading.Lock()
+
+    def embed(self, texts: list) -> np.ndarray:
+        # Mean-pooled, L2-normalized sentence vectors, so a dot product is the cosine similarity
+        import torch
+
+        inputs = self.tokenizer(texts, return_tensors="pt", padding=True, truncation=True, max_length=256)
+        with self._lock, torch.no_grad():
+            hidden = self.model(**inputs).last_hidden_state
+        mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        vectors = pooled.numpy().astype(np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+def get_embedder() -> Embedder:
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                started = time.time()
+                _embedder = Embedder(MEMORY_EMBED_MODEL)
+                print(f"🧭 Memory embedder {MEMORY_EMBED_MODEL} loaded in {round(time.time() - started, 2)}s")
+    return _embedder
+
+def turn_text(dialogue: str, npc_reply: str) -> str:
+    return f"Player: {dialogue}\nDax: {npc_reply or ''}"
+
+class PlayerIndex:
+    # Vectors of one player's turns, mirrored from its record file. Arrays grow by doubling so appends
+    # are amortized O(1).
+    def __init__(self, path: str, dim: int):
+        self.path = path
+        self.dtype = np.dtype([("id", "<i8"), ("vec", "<f4", (dim,))])
+        self.dim = dim
+        self.lock = threading.Lock()
+        self.closed = False     # set by MemoryIndex.reset; a worker still holding it stops writing
+        self._clear()
+        self.refresh()
+
+    def _clear(self):
+        self.size = 0
+        self.ids = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, self.dim), dtype=np.float32)
+        self.known = set()      # ids in self.ids, for O(1) membership checks
+        self.max_id = 0
+        self.offset = 0         # bytes of the file already loaded
+        self.inode = None       # a different inode means another process reset the player
+        self.full_scan = True   # next catch-up compares every stored id (first load, or reset elsewhere)
+
+    def _read_tail(self, f):
+        # Loads complete records appended since the last read; called with self.lock held
+        st = os.fstat(f.fileno())
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            self._clear()
+            self.inode = st.st_ino
+        count = (st.st_size - self.offset) // self.dtype.itemsize
+        if count:
+            f.seek(self.offset)
+            records = np.frombuffer(f.read(count * self.dtype.itemsize), dtype=self.dtype)
+            self._append_arrays(records["id"], records["vec"])
+            self.offset += count * self.dtype.itemsize
+
+    def refresh(self):
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                f = open(self.path, "rb")
+            except FileNotFoundError:
+                if self.inode is not None:
+                    self._clear()
+                return
+            with f:
+                self._read_tail(f)
+
+    def _open_locked(self):
+        # The file currently at self.path, exclusively locked; retried if a reset in another process
+        # replaced it while this one waited for the lock
+        while True:
+            f = open(self.path, "a+b")
+            if fcntl is None:
+                return f
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                if os.stat(self.path).st_ino == os.fstat(f.fileno()).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close()
+
+    def missing(self, ids: list) -> list:
+        with self.lock:
+            return [turn_id for turn_id in ids if turn_id not in self.known]
+
+    def take_full_scan(self) -> bool:
+        with self.lock:
+            full, self.full_scan = self.full_scan, False
+            return full
+
+    def _append_arrays(self, ids: np.ndarray, vectors: np.ndarray):
+        needed = self.size + len(ids)
+        if needed > len(self.ids):
+            capacity = max(needed, 2 * len(self.ids), 64)
+            grown_ids = np.empty(capacity, dtype=np.int64)
+            grown_vectors = np.empty((capacity, self.vectors.shape[1]), dtype=np.float32)
+            grown_ids[:self.size] = self.ids[:self.size]
+            grown_vectors[:self.size] = self.vectors[:self.size]
+            self.ids, self.vectors = grown_ids, grown_vectors
+        self.ids[self.size:needed] = ids
+        self.vectors[self.size:needed] = vectors
+        self.size = needed
+        if len(ids):
+            self.known.update(ids.tolist())
+            self.max_id = max(self.max_id, int(ids.max()))
+
+    def add(self, ids: list, vectors: np.ndarray):
+        records = np.empty(len(ids), dtype=self.dtype)
+        records["id"] = ids
+        records["vec"] = vectors
+        with self.lock:
+            if self.closed:
+                return
+            with self._open_locked() as f:    # closing flushes, then releases the lock
+                self._read_tail(f)
+                # Another process may have embedded some of these turns meanwhile
+                records = records[[turn_id not in self.known for turn_id in records["id"].tolist()]]
+                if not len(records):
+                    return
+                f.write(records.tobytes())
+                self._append_arrays(records["id"], records["vec"])
+                self.offset += len(records) * self.dtype.itemsize
+
+    def search(self, query: np.ndarray, k: int, exclude: set = frozenset(), min_score: float = -1.0) -> list:
+        # Returns [(turn_id, score)] best first
+        with self.lock:
+            ids = self.ids[:self.size]
+            scores = self.vectors[:self.size] @ query
+        wanted = k + len(exclude)
+        if len(scores) > wanted:
+            top = np.argpartition(-scores, wanted)[:wanted]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        results = []
+        for i in top:
+            turn_id = int(ids[i])
+            if turn_id in exclude or scores[i] < min_score:
+                continue
+            results.append((turn_id, float(scores[i])))
+            if len(results) == k:
+                break
+        return results
+
+class MemoryIndex:
+    def __init__(self, session_factory, directory: str = MEMORY_INDEX_DIR, max_players: int = 256):
+        self.session_factory = session_factory
+        self.directory = directory
+        self.max_players = max_players
+        self.searches = 0
+        self.search_seconds = 0.0
+        self.indexed = 0
+        self._players = OrderedDict()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._scheduled = set()
+        self._thread = None
+        self._model_checked = False
+
+    def _path(self, player_id: int) -> str:
+        return os.path.join(self.directory, f"player_{player_id}.vec")
+
+    def _check_model(self, dim: int):
+        # Vectors from another embedding model are meaningless; start over when the model changes
+        os.makedirs(self.directory, exist_ok=True)
+        meta_path = os.path.join(self.directory, "meta.json")
+        meta = {"model": MEMORY_EMBED_MODEL, "dim": dim}
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                if json.load(f) == meta:
+                    return
+            print(f"🧭 Embedding model changed, clearing {self.directory}")
+            for name in os.listdir(self.directory):
+                if name.endswith(".vec"):
+                    os.remove(os.path.join(self.directory, name))
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+
+    def player_index(self, player_id: int) -> PlayerIndex:
+        with self._lock:
+            index = self._players.get(player_id)
+            if index is not None:
+                self._players.move_to_end(player_id)
+                return index
+        dim = get_embedder().dim
+        with self._lock:
+            if not self._model_checked:
+                self._check_model(dim)
+                self._model_checked = True
+            index = self._players.get(player_id)
+            if index is None:
+                index = PlayerIndex(self._path(player_id), dim)
+                self._players[player_id] = index
+                while len(self._players) > self.max_players:
+                    self._players.popitem(last=False)
+            return index
+
+    def notify(self, player_id: int):
+        # A player has new turns; the worker embeds everything not indexed yet
+        if not MEMORY_RETRIEVAL:
+            return
+        with self._lock:
+            if player_id in self._scheduled:
+                return
+            self._scheduled.add(player_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="memory-index", daemon=True)
+                self._thread.start()
+        self._queue.put(player_id)
+
+    def reset(self, player_id: int):
+        # Called when a turn is edited or deleted: drop the player's vectors and rebuild them
+        with self._lock:
+            index = self._players.pop(player_id, None)
+        if index is not None:
+            with index.lock:
+                index.closed = True
+                if os.path.exists(index.path):
+                    os.remove(index.path)
+        elif os.path.exists(self._path(player_id)):
+            os.remove(self._path(player_id))
+        self.notify(player_id)
+
+    def catch_up(self, player_id: int) -> int:
+        # Embeds the stored turns missing from the file. A full scan compares every stored id, so gaps
+        # left by another process (e.g. one racing a reset) are filled too; otherwise only the ids from
+        # a little below the newest indexed one are checked.
+        index = self.player_index(player_id)
+        index.refresh()
+        full = index.take_full_scan()
+        try:
+            return self._embed_missing(index, player_id, full)
+        except Exception:
+            if full:
+                index.full_scan = True
+            raise
+
+    def _embed_missing(self, index: PlayerIndex, player_id: int, full: bool) -> int:
+        db = self.session_factory()
+        try:
+            query = db.query(NPCMemory.id).filter(NPCMemory.player_id == player_id)
+            if not full:
+                query = query.filter(NPCMemory.id > index.max_id - MEMORY_INDEX_LOOKBACK)
+            stored = [row.id for row in query.order_by(NPCMemory.id)]
+        finally:
+            db.close()
+        missing = index.missing(stored)
+        added = 0
+        for page in range(0, len(missing), MEMORY_EMBED_BATCH * 8):
+            if index.closed:
+                break
+            db = self.session_factory()
+            try:
+                rows = (
+                    db.query(NPCMemory.id, NPCMemory.dialogue, NPCMemory.npc_reply)
+                    .filter(NPCMemory.id.in_(missing[page:page + MEMORY_EMBED_BATCH * 8]))
+                    .order_by(NPCMemory.id)
+                    .all()
+                )
+            finally:
+                db.close()
+            for start in range(0, len(rows), MEMORY_EMBED_BATCH):
+                chunk = rows[start:start + MEMORY_EMBED_BATCH]
+                vectors = get_embedder().embed([turn_text(r.dialogue, r.npc_reply) for r in chunk])
+                index.add([r.id for r in chunk], vectors)
+                added += len(chunk)
+            self.indexed += len(rows)
+        return added
+
+    def _run(self):
+        while True:
+            player_id = self._queue.get()
+            with self._lock:
+                self._scheduled.discard(player_id)
+            try:
+                added = self.catch_up(player_id)
+                if added:
+                    print(f"🧭 Memory index: embedded {added} turns for player {player_id}")
+            except Exception as e:
+                print(f"Memory index update failed for player {player_id}: ", e)
+
+    def search(self, player_id: int, dialogue: str, k: int = MEMORY_RETRIEVAL_K, exclude: set = frozenset()) -> list:
+        started = time.perf_counter()
+        index = self.player_index(player_id)
+        index.refresh()     # turns appended by other worker processes
+        query = get_embedder().embed([dialogue])[0]
+        results = index.search(query, k, exclude, MEMORY_RETRIEVAL_MIN_SCORE)
+        self.searches += 1
+        self.search_seconds += time.perf_counter() - started
+        return results
+
+    def stats(self) -> dict:
+        with self._lock:
+            loaded = len(self._players)
+            queued = len(self._scheduled)
+        return {
+            "enabled": MEMORY_RETRIEVAL,
+            "players_loaded": loaded,
+            "queued": queued,
+            "turns_indexed": self.indexed,
+            "searches": self.searches,
+            "avg_search_ms": round(self.search_seconds / self.searches * 1000, 2) if self.searches else 0.0,
+        }
+
+memory_index = None
+
+def get_memory_index(session_factory=None) -> MemoryIndex:
+    global memory_index
+    if memory_index is None:
+        if session_factory is None:
+            from database import SessionLocal
+            session_factory = SessionLocal
+        memory_index = MemoryIndex(session_factory, MEMORY_INDEX_DIR, MEMORY_INDEX_PLAYERS)
+    return memory_index
+
+def recall_turns(player_id: int, dialogue: str, exclude_ids: set = frozenset(), k: int = MEMORY_RETRIEVAL_K) -> list:
+    # The K stored turns most relevant to `dialogue`, best match first; [] when disabled or on any failure
+    if not MEMORY_RETRIEVAL or k <= 0:
+        return []
+    index = get_memory_index()
+    try:
+        hits = index.search(player_id, dialogue, k, exclude_ids)
+    except Exception as e:
+        print("Memory recall failed: ", e)
+        return []
+    finally:
+        index.notify(player_id)
+    if not hits:
+        return []
+    db = index.session_factory()
+    try:
+        rows = db.query(NPCMemory).filter(NPCMemory.id.in_([turn_id for turn_id, _ in hits])).all()
+        db.expunge_all()
+    finally:
+        db.close()
+    rank = {turn_id: i for i, (turn_id, _) in enumerate(hits)}
+    return sorted(rows, key=lambda row: rank[row.id])
+
+async def recall_turns_async(player_id: int, dialogue: str, exclude_ids: set = frozenset(), k: int = MEMORY_RETRIEVAL_K) -> list:
+    return await asyncio.to_thread(recall_turns, player_id, dialogue, exclude_ids, k)
+
+def merge_recalled(recalled: list, recent: list, k: int = MEMORY_RETRIEVAL_K) -> list:
+    # Prompt history: the best k recalled turns not already among the recent ones (in chronological
+    # order), then the recent turns. The recent turns stay last, so the token budget trims recalled
+    # turns first and the session-context check still sees the latest exchange.
+    recent_ids = {turn.id for turn in recent if turn.id is not None}
+    kept = [turn for turn in recalled if turn.id not in recent_ids][:k]
+    return sorted(kept, key=lambda turn: turn.id) + list(recent)
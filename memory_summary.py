@@ -0,0 +1,202 @@
+import os, json, queue, threading
+from datetime import datetime
+from models import NPCMemory, PlayerMemorySummary
+from deepseek import LLM_MODEL, LLM_KEEP_ALIVE
+from context_budget import LLM_CONTEXT_TOKENS
+from llm_client import get_llm_client
+from llm_scheduler import LLMBusyError
+from context_cache import record_summary
+
+# Rolling memory: turns older than the most recent MEMORY_RECENT_TURNS are folded into a per-player
+# summary (player_memory_summary) by a background worker. Each fold takes the previous summary plus a
+# batch of not-yet-summarized turns and asks the LLM for an updated summary, so the prompt carries
+# summary + the turns after it and stays bounded however long the history gets.
+MEMORY_SUMMARY = os.getenv("MEMORY_SUMMARY", "1") == "1"
+MEMORY_RECENT_TURNS = int(os.getenv("MEMORY_RECENT_TURNS", "2"))      # sent verbatim, never summarized
+MEMORY_SUMMARY_MIN_TURNS = int(os.getenv("MEMORY_SUMMARY_MIN_TURNS", "6"))  # fold once this many are waiting
+MEMORY_SUMMARY_BATCH = int(os.getenv("MEMORY_SUMMARY_BATCH", "20"))
+MEMORY_SUMMARY_TOKENS = int(os.getenv("MEMORY_SUMMARY_TOKENS", "160"))
+MEMORY_SUMMARY_QUEUE_TIMEOUT = 5  # folds use the scheduler's background lane; a busy LLM just postpones the fold
+
+SUMMARY_SYSTEM = """
+    You maintain the long-term memory of Dax, an F1 race engineer, about one player.
+    Merge the existing memory with the new conversation turns into one short paragraph (at most 80 words).
+    Keep what matters for future conversations: car parts the player chose or rejected, preferences,
+    goals, worries, and anything personal they shared. Drop greetings and small talk.
+    Write plain facts in the third person. Output only the updated memory.
+"""
+
+# Every turn after the summary's watermark is sent verbatim. A fold waits for MEMORY_SUMMARY_MIN_TURNS
+# turns behind the recent ones, so up to MEMORY_SUMMARY_MIN_TURNS - 1 + MEMORY_RECENT_TURNS turns can
+# be unsummarized; more only while folds keep failing (then the oldest of them are left out)
+MEMORY_CONTEXT_TURNS = MEMORY_RECENT_TURNS + max(MEMORY_SUMMARY_MIN_TURNS - 1, 0) if MEMORY_SUMMARY else MEMORY_RECENT_TURNS
+
+def prompt_turns(player_ctx) -> list:
+    # The turns sent verbatim with the summary, oldest first
+    if not MEMORY_SUMMARY:
+        return player_ctx.recent_turns(MEMORY_RECENT_TURNS)
+    return player_ctx.unsummarized_turns(MEMORY_RECENT_TURNS, MEMORY_CONTEXT_TURNS)
+
+def build_summary_prompt(previous: str, turns: list) -> str:
+    lines = "\n".join(f"Player: {t.dialogue}\nDax: {t.npc_reply}" for t in turns)
+    return f"""
+    Existing memory: {previous or "None yet."}
+
+    New conversation turns:
+{lines}
+
+    Updated memory:
+    """
+
+def summarize(previous: str, turns: list) -> str:
+    payload = {
+        "model": LLM_MODEL,
+        "system": SUMMARY_SYSTEM,
+        "prompt": build_summary_prompt(previous, turns),
+        "stream": False,
+        "keep_alive": LLM_KEEP_ALIVE,
+        # Same num_ctx as chat requests: a different value makes Ollama reload the model
+        "options": {"temperature": 0.2, "num_predict": MEMORY_SUMMARY_TOKENS, "num_ctx": LLM_CONTEXT_TOKENS},
+    }
+    response = get_llm_client().generate_sync(payload, queue_timeout=MEMORY_SUMMARY_QUEUE_TIMEOUT, background=True)
+    if response.status_code != 200:
+        raise RuntimeError(f"LLM service returned status {response.status_code}")
+    summary = json.loads(response.text).get("response", "").strip()
+    if not summary:
+        raise RuntimeError("LLM returned an empty summary")
+    return summary
+
+def pending_turns(db, player_id: int, after_id: int) -> list:
+    # Turns after the watermark, excluding the most recent ones that are sent verbatim
+    recent = (
+        db.query(NPCMemory.id)
+        .filter(NPCMemory.player_id == player_id)
+        .order_by(NPCMemory.id.desc())
+        .limit(MEMORY_RECENT_TURNS)
+        .all()
+    )
+    if len(recent) < MEMORY_RECENT_TURNS:
+        return []
+    query = db.query(NPCMemory).filter(NPCMemory.player_id == player_id, NPCMemory.id > after_id)
+    if recent:
+        query = query.filter(NPCMemory.id < recent[-1].id)
+    return query.order_by(NPCMemory.id).limit(MEMORY_SUMMARY_BATCH).all()
+
+def load_fold_input(session_factory, player_id: int):
+    db = session_factory()
+    try:
+        row = db.query(PlayerMemorySummary).filter(PlayerMemorySummary.player_id == player_id).first()
+        previous = (row.summary, row.last_memory_id) if row else None
+        turns = pending_turns(db, player_id, previous[1] if previous else 0)
+        db.expunge_all()
+        return previous, turns
+    finally:
+        db.close()
+
+def save_fold(session_factory, player_id: int, previous, summary: str, turns: list) -> bool:
+    # Compare-and-set on the watermark, so a fold racing with another worker (or a reset) is discarded
+    db = session_factory()
+    try:
+        if previous is None:
+            db.add(PlayerMemorySummary(
+                player_id=player_id, summary=summary, last_memory_id=turns[-1].id,
+                turns_summarized=len(turns), updated_at=datetime.utcnow(),
+            ))
+            updated = 1
+        else:
+            updated = db.query(PlayerMemorySummary).filter(
+                PlayerMemorySummary.player_id == player_id,
+                PlayerMemorySummary.last_memory_id == previous[1],
+            ).update({
+                "summary": summary,
+                "last_memory_id": turns[-1].id,
+                "turns_summarized": PlayerMemorySummary.turns_summarized + len(turns),
+                "updated_at": datetime.utcnow(),
+            }, synchronize_session=False)
+        db.commit()
+        return updated == 1
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def fold_player(session_factory, player_id: int, min_turns: int = MEMORY_SUMMARY_MIN_TURNS) -> int:
+    # Folds waiting turns into the player's summary, one batch at a time; returns turns folded.
+    # No DB session is held while the LLM writes the summary.
+    folded = 0
+    while True:
+        previous, turns = load_fold_input(session_factory, player_id)
+        if not turns or len(turns) < min_turns:
+            return folded
+        summary = summarize(previous[0] if previous else "", turns)
+        if not save_fold(session_factory, player_id, previous, summary, turns):
+            print(f"Memory summary for player {player_id} changed during the fold; discarded")
+            return folded
+        record_summary(player_id, summary, turns[-1].id)
+        folded += len(turns)
+        print(f"🗂️ Memory summary for player {player_id}: folded {len(turns)} turns ({folded} this run)")
+        if len(turns) < MEMORY_SUMMARY_BATCH:
+            return folded
+
+def reset_summary(db, player_id: int, memory_id: int = None):
+    # Drops the summary when an already-folded turn is edited or deleted, so it gets rebuilt from the
+    # DB. Runs in the caller's session/transaction; the caller also invalidates the context cache.
+    query = db.query(PlayerMemorySummary).filter(PlayerMemorySummary.player_id == player_id)
+    if memory_id is not None:
+        query = query.filter(PlayerMemorySummary.last_memory_id >= memory_id)
+    query.delete(synchronize_session=False)
+
+class MemorySummarizer:
+    # Single background worker; a player is queued at most once however many turns arrive meanwhile
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self.runs = 0
+        self.turns_folded = 0
+        self.failures = 0
+        self._queue = queue.Queue()
+        self._scheduled = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def schedule(self, player_id: int):
+        if not MEMORY_SUMMARY:
+            return
+        with self._lock:
+            if player_id in self._scheduled:
+                return
+            self._scheduled.add(player_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="memory-summary", daemon=True)
+                self._thread.start()
+        self._queue.put(player_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            queued = len(self._scheduled)
+        return {"enabled": MEMORY_SUMMARY, "queued": queued, "runs": self.runs, "turns_folded": self.turns_folded, "failures": self.failures}
+
+    def _run(self):
+        while True:
+            player_id = self._queue.get()
+            with self._lock:
+                self._scheduled.discard(player_id)
+            try:
+                self.turns_folded += fold_player(self.session_factory, player_id)
+                self.runs += 1
+            except LLMBusyError:
+                pass  # retried when the player's next turn arrives
+            except Exception as e:
+                self.failures += 1
+                print(f"Memory summary failed for player {player_id}: ", e)
+
+summarizer = None
+
+def get_summarizer(session_factory=None) -> MemorySummarizer:
+    global summarizer
+    if summarizer is None:
+        if session_factory is None:
+            from database import SessionLocal
+            session_factory = SessionLocal
+        summarizer = MemorySummarizer(session_factory)
+    return summarizer
@@ -0,0 +1,168 @@
+import bisect, contextvars, threading, time
+
+# Minimal Prometheus instrumentation (text exposition format 0.0.4), served from /metrics.
+# Recording is a dict lookup plus a few additions under a per-metric lock, cheap enough to leave on.
+# Histograms keep one counter per bucket and are made cumulative only when scraped.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for label_values, value in items:
+            yield self.name, _format_labels(self.labels, label_values), value
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}   # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(s[0]), s[1], s[2]) for labels, s in self._series.items()]
+        for label_values, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(float(bound)) + '"'
+                yield f"{self.name}_bucket", _format_labels(self.labels, label_values, le), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labels, label_values), total
+            yield f"{self.name}_count", _format_labels(self.labels, label_values), count
+
+class Callback:
+    # Values read at scrape time from stats() functions the app already has (cache hit counters, queues)
+    def __init__(self, name: str, help: str, kind: str, labels: tuple, collect):
+        self.name, self.help, self.kind, self.labels = name, help, kind, tuple(labels)
+        self.collect = collect
+
+    def samples(self):
+        try:
+            values = self.collect()
+        except Exception:
+            return
+        for label_values, value in values:
+            yield self.name, _format_labels(self.labels, label_values), value
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+def counter(name: str, help: str, labels: tuple = ()) -> Counter:
+    return registry.register(Counter(name, help, labels))
+
+def histogram(name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+    return registry.register(Histogram(name, help, labels, buckets))
+
+def callback(name: str, help: str, kind: str, labels: tuple, collect) -> Callback:
+    return registry.register(Callback(name, help, kind, labels, collect))
+
+# Metrics recorded from several modules
+STAGE_SECONDS = histogram("npc_stage_seconds", "Duration of a request pipeline stage.", ("endpoint", "stage"))
+HTTP_SECONDS = histogram("npc_http_request_seconds", "HTTP request duration.", ("method", "route", "status"))
+DB_QUERIES = histogram("npc_db_queries_per_request", "SQL statements executed per HTTP request.", ("route",), SIZE_BUCKETS)
+LLM_PROMPT_TOKENS = histogram("npc_llm_prompt_tokens", "Prompt tokens evaluated per generation (Ollama prompt_eval_count).", ("context",), TOKEN_BUCKETS)
+LLM_EVAL_TOKENS = histogram("npc_llm_eval_tokens", "Tokens generated per reply (Ollama eval_count).", (), TOKEN_BUCKETS)
+LLM_PROMPT_EVAL_SECONDS = histogram("npc_llm_prompt_eval_seconds", "Prompt evaluation time reported by Ollama.", ("context",))
+LLM_EVAL_SECONDS = histogram("npc_llm_eval_seconds", "Reply generation time reported by Ollama.")
+SENTIMENT_BATCH_SIZE = histogram("npc_sentiment_batch_size", "Texts per sentiment forward pass.", (), SIZE_BUCKETS)
+SENTIMENT_SECONDS = histogram("npc_sentiment_inference_seconds", "Duration of one sentiment forward pass.")
+
+# SQL statements of the current request; a mutable holder so worker threads that inherit the
+# context (threadpool, asyncio.to_thread) add to the same count
+_request_queries = contextvars.ContextVar("npc_request_queries", default=None)
+
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        holder = _request_queries.get()
+        if holder is not None:
+            holder[0] += 1
+
+class MetricsMiddleware:
+    # Plain ASGI middleware: request duration and SQL count per route template (not raw path, which
+    # would create a series per player id)
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        holder = [0]
+        token = _request_queries.set(holder)
+        status = {"code": 500}
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_queries.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            if route != "/metrics":
+                HTTP_SECONDS.observe(time.perf_counter() - started, scope["method"], route, str(status["code"]))
+                DB_QUERIES.observe(holder[0], route)
+
+def render() -> str:
+    return registry.render()
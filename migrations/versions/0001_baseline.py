@@ -0,0 +1,59 @@
+"""Baseline schema (the tables previously created by Base.metadata.create_all)
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Existing deployments already have these tables from create_all; only create what is missing
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+
+    if "npc_memory" not in existing:
+        op.create_table(
+            "npc_memory",
+            sa.Column("id", sa.Integer, primary_key=True, index=True),
+            sa.Column("player_id", sa.Integer, nullable=False),
+            sa.Column("npc_id", sa.Integer, nullable=False),
+            sa.Column("dialogue", sa.String, nullable=False),
+            sa.Column("sentiment", sa.String, nullable=True),
+            sa.Column("timestamp", sa.DateTime),
+            sa.Column("npc_reply", sa.String, nullable=True),
+            sa.Column("npc_sentiment", sa.String, nullable=True),
+        )
+
+    if "players" not in existing:
+        op.create_table(
+            "players",
+            sa.Column("id", sa.Integer, primary_key=True, index=True),
+            sa.Column("name", sa.String, nullable=False, unique=True, index=True),
+            sa.Column("email", sa.String, nullable=True),
+            sa.Column("role", sa.String),
+            sa.Column("display_name", sa.String, nullable=True),
+        )
+
+    if "car_builds" not in existing:
+        op.create_table(
+            "car_builds",
+            sa.Column("id", sa.Integer, primary_key=True, index=True),
+            sa.Column("player_id", sa.Integer, sa.ForeignKey("players.id")),
+            sa.Column("chassis", sa.String),
+            sa.Column("engine", sa.String),
+            sa.Column("tires", sa.String),
+            sa.Column("frontWing", sa.String),
+            sa.Column("rearWing", sa.String),
+            sa.Column("car_image", sa.String),
+            sa.Column("timestamp", sa.DateTime),
+        )
+
+def downgrade():
+    op.drop_table("car_builds")
+    op.drop_table("players")
+    op.drop_table("npc_memory")
@@ -0,0 +1,69 @@
+"""Composite indexes for npc_memory hot queries and a dialogue hash for the duplicate check
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+import hashlib
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+INDEXES = {
+    # chat history: player_id = X ORDER BY timestamp DESC LIMIT n
+    "ix_npc_memory_player_timestamp": ["player_id", "timestamp"],
+    # get_interactions: (player_id, npc_id) ORDER BY timestamp DESC
+    "ix_npc_memory_player_npc_timestamp": ["player_id", "npc_id", "timestamp"],
+    # store_interaction duplicate check
+    "ix_npc_memory_player_npc_dialogue_hash": ["player_id", "npc_id", "dialogue_hash"],
+}
+
+BACKFILL_BATCH = 10000
+
+def backfill_dialogue_hash(bind):
+    if bind.dialect.name == "postgresql":
+        bind.execute(sa.text(
+            "UPDATE npc_memory SET dialogue_hash = encode(sha256(convert_to(dialogue, 'UTF8')), 'hex') "
+            "WHERE dialogue_hash IS NULL"
+        ))
+        return
+
+    while True:
+        rows = bind.execute(sa.text(
+            "SELECT id, dialogue FROM npc_memory WHERE dialogue_hash IS NULL LIMIT :n"
+        ), {"n": BACKFILL_BATCH}).fetchall()
+        if not rows:
+            break
+        bind.execute(
+            sa.text("UPDATE npc_memory SET dialogue_hash = :h WHERE id = :id"),
+            [{"id": row.id, "h": hashlib.sha256(row.dialogue.encode("utf-8")).hexdigest()} for row in rows],
+        )
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    columns = {c["name"] for c in inspector.get_columns("npc_memory")}
+    existing_indexes = {i["name"] for i in inspector.get_indexes("npc_memory")}
+
+    if "dialogue_hash" not in columns:
+        op.add_column("npc_memory", sa.Column("dialogue_hash", sa.String(64), nullable=True))
+    backfill_dialogue_hash(bind)
+
+    missing = {name: cols for name, cols in INDEXES.items() if name not in existing_indexes}
+    if bind.dialect.name == "postgresql":
+        # CONCURRENTLY keeps npc_memory writable while large indexes build; it can't run in a transaction
+        with op.get_context().autocommit_block():
+            for name, cols in missing.items():
+                op.create_index(name, "npc_memory", cols, postgresql_concurrently=True)
+    else:
+        for name, cols in missing.items():
+            op.create_index(name, "npc_memory", cols)
+
+def downgrade():
+    for name in INDEXES:
+        op.drop_index(name, table_name="npc_memory")
+    op.drop_column("npc_memory", "dialogue_hash")
@@ -0,0 +1,29 @@
+"""Rolling per-player memory summary
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # create_all at app startup may have created it already
+    if "player_memory_summary" in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        "player_memory_summary",
+        sa.Column("player_id", sa.Integer, primary_key=True),
+        sa.Column("summary", sa.Text, nullable=False),
+        sa.Column("last_memory_id", sa.Integer, nullable=False),
+        sa.Column("turns_summarized", sa.Integer, nullable=False),
+        sa.Column("updated_at", sa.DateTime),
+    )
+
+def downgrade():
+    op.drop_table("player_memory_summary")
@@ -0,0 +1,28 @@
+"""Shared TurboTom walkthrough state (previously a per-process dict)
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # create_all at app startup may have created it already
+    if "turbotom_state" in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        "turbotom_state",
+        sa.Column("player_id", sa.Integer, primary_key=True),
+        sa.Column("state", sa.String(64), nullable=False),
+        sa.Column("version", sa.Integer, nullable=False),
+        sa.Column("updated_at", sa.DateTime),
+    )
+
+def downgrade():
+    op.drop_table("turbotom_state")
@@ -1,6 +1,11 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Index
+from sqlalchemy.orm import validates
 from datetime import datetime
 from database import Base
+import hashlib
+
+def hash_dialogue(dialogue: str) -> str:
+    return hashlib.sha256(dialogue.encode("utf-8")).hexdigest()
 
 class NPCMemory(Base):
     __tablename__ = "npc_memory"
@@ -13,6 +18,19 @@ class NPCMemory(Base):
     timestamp = Column(DateTime, default=datetime.utcnow)
     npc_reply = Column(String, nullable=True)
     npc_sentiment = Column(String, nullable=True)
+    dialogue_hash = Column(String(64), nullable=True)  # sha256 of dialogue, used by the duplicate check
+
+    # Keep in sync with migrations/versions
+    __table_args__ = (
+        Index("ix_npc_memory_player_npc_timestamp", "player_id", "npc_id", "timestamp"),
+        Index("ix_npc_memory_player_timestamp", "player_id", "timestamp"),
+        Index("ix_npc_memory_player_npc_dialogue_hash", "player_id", "npc_id", "dialogue_hash"),
+    )
+
+    @validates("dialogue")
+    def _set_dialogue_hash(self, key, dialogue):
+        self.dialogue_hash = hash_dialogue(dialogue) if dialogue is not None else None
+        return dialogue
 
 class Player(Base):
     __tablename__ = "players"
@@ -33,3 +51,20 @@ class CarBuild(Base):
     rearWing = Column(String)
     car_image = Column(String)
     timestamp = Column(DateTime, default=datetime.utcnow) 
+
+class PlayerMemorySummary(Base):
+    # Rolling summary of a player's older NPCMemory turns; rows up to last_memory_id are folded in
+    __tablename__ = "player_memory_summary"
+    player_id = Column(Integer, primary_key=True)
+    summary = Column(Text, nullable=False, default="")
+    last_memory_id = Column(Integer, nullable=False, default=0)
+    turns_summarized = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class TurboTomState(Base):
+    # Position of a player in the TurboTom build walkthrough; version is bumped on every transition
+    __tablename__ = "turbotom_state"
+    player_id = Column(Integer, primary_key=True)
+    state = Column(String(64), nullable=False)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
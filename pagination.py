@@ -0,0 +1,35 @@
+import base64, os
+from datetime import datetime
+from sqlalchemy import and_, or_
+from models import NPCMemory
+
+# Keyset (timestamp, id) pagination over NPCMemory, newest first. A cursor points at the last row of
+# a page; the next page is everything strictly older, so each page costs one index range scan
+# no matter how deep into the history it is.
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+HISTORY_MAX_PAGE_SIZE = 200
+
+def encode_cursor(row) -> str:
+    raw = f"{row.timestamp.isoformat()}|{row.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, row_id = base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def fetch_page(query, cursor: str = None, limit: int = HISTORY_PAGE_SIZE):
+    # Returns (rows newest-first, cursor for the next older page or None)
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        query = query.filter(or_(
+            NPCMemory.timestamp < timestamp,
+            and_(NPCMemory.timestamp == timestamp, NPCMemory.id < row_id),
+        ))
+    rows = query.order_by(NPCMemory.timestamp.desc(), NPCMemory.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
@@ -0,0 +1,142 @@
+# Offline re-scoring of npc_memory.sentiment / npc_sentiment, e.g. after switching SENTIMENT_BACKEND
+# or upgrading the sentiment model. Rows are read in id order (keyset pages, streamed through a
+# server-side cursor where the driver supports it), scored in large padded batches and written back
+# with bulk updates. Progress is checkpointed after every committed page, so an interrupted run
+# resumes where it stopped.
+#
+#   python rescore_sentiment.py --backend onnx-int8
+#   python rescore_sentiment.py --restart --batch-size 128 --page-size 10000
+#   python rescore_sentiment.py --dry-run --limit 5000
+#
+# Running app workers keep their in-process caches; restart them (or wait for the TTLs) afterwards.
+import argparse, json, os, sys, time
+from sentiment import load_backend, normalize_text, MODEL_NAME, SENTIMENT_BACKEND
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Re-score sentiment columns of historical npc_memory rows.")
+    parser.add_argument("--backend", default=SENTIMENT_BACKEND, help="torch, torch-int8, onnx or onnx-int8")
+    parser.add_argument("--batch-size", type=int, default=64, help="texts per padded forward pass")
+    parser.add_argument("--page-size", type=int, default=5000, help="rows per read/update/commit")
+    parser.add_argument("--checkpoint", default="rescore_sentiment.checkpoint.json")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--limit", type=int, default=0, help="stop after this many rows (0 = all)")
+    parser.add_argument("--dry-run", action="store_true", help="score and report, but write nothing")
+    return parser.parse_args()
+
+def load_checkpoint(path: str, backend: str) -> dict:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("backend") != backend or checkpoint.get("model") != MODEL_NAME:
+        raise SystemExit(
+            f"Checkpoint {path} was written for {checkpoint.get('model')} ({checkpoint.get('backend')}); "
+            "use --restart to start over with the current model"
+        )
+    return checkpoint
+
+def save_checkpoint(path: str, checkpoint: dict):
+    # Written to a temp file and renamed, so a crash never leaves a half-written checkpoint
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp, path)
+
+def read_page(session_factory, after_id: int, page_size: int) -> list:
+    from models import NPCMemory
+
+    db = session_factory()
+    try:
+        query = (
+            db.query(NPCMemory.id, NPCMemory.dialogue, NPCMemory.npc_reply, NPCMemory.sentiment, NPCMemory.npc_sentiment)
+            .filter(NPCMemory.id > after_id)
+            .order_by(NPCMemory.id)
+            .limit(page_size)
+            .execution_options(stream_results=True, yield_per=min(page_size, 1000))
+        )
+        return [tuple(row) for row in query]
+    finally:
+        db.close()
+
+def score_texts(backend, texts: list, batch_size: int) -> dict:
+    # Unique normalized texts only, sorted by length so each padded batch wastes little compute
+    unique = sorted({t for t in texts if t}, key=len)
+    labels = {}
+    for start in range(0, len(unique), batch_size):
+        chunk = unique[start:start + batch_size]
+        labels.update(zip(chunk, backend.predict(chunk)))
+    return labels
+
+def main():
+    args = parse_args()
+    from database import SessionLocal
+    from models import NPCMemory
+
+    checkpoint = None if args.restart else load_checkpoint(args.checkpoint, args.backend)
+    if checkpoint:
+        print(f"Resuming after id {checkpoint['last_id']} ({checkpoint['rows']} rows already done)")
+    else:
+        checkpoint = {"backend": args.backend, "model": MODEL_NAME, "last_id": 0, "rows": 0, "changed": 0, "seconds": 0.0}
+
+    started = time.perf_counter()
+    backend = load_backend(args.backend)
+    print(f"Loaded {backend.name} backend in {time.perf_counter() - started:.1f}s")
+
+    run_rows = 0
+    run_started = time.perf_counter()
+    while not args.limit or run_rows < args.limit:
+        page_size = args.page_size if not args.limit else min(args.page_size, args.limit - run_rows)
+        page_started = time.perf_counter()
+        rows = read_page(SessionLocal, checkpoint["last_id"], page_size)
+        if not rows:
+            break
+        read_seconds = time.perf_counter() - page_started
+
+        dialogues = [normalize_text(dialogue or "") for _, dialogue, _, _, _ in rows]
+        replies = [normalize_text(reply) if reply is not None else None for _, _, reply, _, _ in rows]
+        scored = score_texts(backend, dialogues + [r for r in replies if r], args.batch_size)
+        score_seconds = time.perf_counter() - page_started - read_seconds
+
+        updates = []
+        for (row_id, _, _, old_sentiment, old_npc_sentiment), dialogue, reply in zip(rows, dialogues, replies):
+            # Same convention as analyze_sentiment: empty text is neutral; rows without a reply keep NULL
+            sentiment = scored.get(dialogue, "neutral")
+            npc_sentiment = scored.get(reply, "neutral") if reply is not None else old_npc_sentiment
+            if (sentiment, npc_sentiment) != (old_sentiment, old_npc_sentiment):
+                updates.append({"id": row_id, "sentiment": sentiment, "npc_sentiment": npc_sentiment})
+
+        if not args.dry_run and updates:
+            db = SessionLocal()
+            try:
+                db.bulk_update_mappings(NPCMemory, updates)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+        write_seconds = time.perf_counter() - page_started - read_seconds - score_seconds
+
+        run_rows += len(rows)
+        checkpoint["last_id"] = rows[-1][0]
+        checkpoint["rows"] += len(rows)
+        checkpoint["changed"] += len(updates)
+        checkpoint["seconds"] = round(checkpoint["seconds"] + time.perf_counter() - page_started, 3)
+        if not args.dry_run:
+            save_checkpoint(args.checkpoint, checkpoint)
+
+        elapsed = time.perf_counter() - run_started
+        print(
+            f"  up to id {checkpoint['last_id']}: {checkpoint['rows']} rows, {checkpoint['changed']} changed | "
+            f"{run_rows / elapsed:.0f} rows/s (read {read_seconds:.2f}s, score {score_seconds:.2f}s, write {write_seconds:.2f}s)"
+        )
+
+    elapsed = time.perf_counter() - run_started
+    rate = run_rows / elapsed if elapsed else 0.0
+    print(f"Done: {run_rows} rows this run in {elapsed:.1f}s ({rate:.0f} rows/s), {checkpoint['changed']} rows changed in total")
+    if args.dry_run:
+        print("Dry run: nothing was written and no checkpoint was saved")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
 # Model for creating a new interaction (POST)
 class NPCMemoryCreate(BaseModel):
@@ -39,6 +39,43 @@ class NPCMemoryResponse(NPCMemoryCreate):
     class Config:
         from_attributes = True
     
+# Model for one page of cursor-paginated history (oldest first within the page)
+class NPCMemoryPage(BaseModel):
+    items: List[NPCMemoryResponse]
+    next_cursor: Optional[str] = None
+
+# Batch chat (POST /chat_batch): many players' messages in one request, one result per item in the same order
+class ChatBatchItem(BaseModel):
+    player_id: int
+    npc_id: int = 1
+    dialogue: str
+
+class ChatBatchRequest(BaseModel):
+    items: List[ChatBatchItem]
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "items": [
+                    {"player_id": 1, "npc_id": 1, "dialogue": "Should I run slicks today?"},
+                    {"player_id": 2, "npc_id": 1, "dialogue": "Hey Dax!"}
+                ]
+            }
+        }
+
+class ChatBatchResult(BaseModel):
+    player_id: int
+    npc_id: int
+    status: str                           # ok, not_found, busy or error
+    id: Optional[int] = None              # stored NPCMemory row (status ok)
+    sentiment: Optional[str] = None
+    npc_reply: Optional[str] = None
+    retry_after: Optional[float] = None   # seconds (status busy)
+    detail: Optional[str] = None
+
+class ChatBatchResponse(BaseModel):
+    results: List[ChatBatchResult]
+
 class PlayerCreate(BaseModel):
     name: str
     email: Optional[str] = None
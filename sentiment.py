@@ -1,19 +1,445 @@
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
-import torch
+from concurrent.futures import Future, InvalidStateError
+from collections import OrderedDict
 import numpy as np
+import os, json, time, queue, socket, struct, asyncio, threading
+from metrics import SENTIMENT_SECONDS, SENTIMENT_BATCH_SIZE
 
-# Load RoBERTa model and tokenizer
-tokenizer = AutoTokenizer.from_pretrained("cardiffnlp/twitter-roberta-base-sentiment")
-model = AutoModelForSequenceClassification.from_pretrained("cardiffnlp/twitter-roberta-base-sentiment")
+MODEL_NAME = "cardiffnlp/twitter-roberta-base-sentiment"
 
 labels = ['negative', 'neutral', 'positive']
 
+# torch/transformers are imported and the model is loaded lazily on first use (or by warmup()),
+# so importing this module stays cheap for workers and processes that never score text.
+# Inference backend: torch (full precision), torch-int8 (dynamic quantization),
+# onnx or onnx-int8 (ONNX Runtime on CPU, exported on first use if the file is missing),
+# remote (the model lives in sentiment_server.py and workers call it over SENTIMENT_SOCKET)
+SENTIMENT_BACKEND = os.getenv("SENTIMENT_BACKEND", "torch")
+SENTIMENT_SOCKET = os.getenv("SENTIMENT_SOCKET", "/tmp/npc-sentiment.sock")
+SENTIMENT_ONNX_PATH = os.getenv("SENTIMENT_ONNX_PATH", "onnx_models/twitter-roberta-base-sentiment.onnx")
+SENTIMENT_THREADS = int(os.getenv("SENTIMENT_THREADS", "0"))
+
+# Micro-batching settings: concurrent calls are gathered for up to SENTIMENT_MAX_WAIT_MS
+# (or until SENTIMENT_MAX_BATCH texts are queued) and scored in one padded forward pass
+SENTIMENT_MAX_BATCH = int(os.getenv("SENTIMENT_MAX_BATCH", "16"))
+SENTIMENT_MAX_WAIT_MS = float(os.getenv("SENTIMENT_MAX_WAIT_MS", "5"))
+# Max number of normalized texts kept in the result cache (0 disables it)
+SENTIMENT_CACHE_SIZE = int(os.getenv("SENTIMENT_CACHE_SIZE", "4096"))
+
+def normalize_text(text: str) -> str:
+    return text.strip().lower()
+
+class TorchBackend:
+    def __init__(self, model_name: str = MODEL_NAME, quantize: bool = False):
+        import torch
+        from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+        self.name = "torch-int8" if quantize else "torch"
+        self.model_name = model_name
+        if SENTIMENT_THREADS > 0:
+            torch.set_num_threads(SENTIMENT_THREADS)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        model.eval()
+        if quantize:
+            # int8 weights for every Linear layer; activations are quantized on the fly
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+
+    def scores(self, texts: list) -> np.ndarray:
+        import torch
+
+        inputs = self.tokenizer(texts, return_tensors="pt", padding=True, truncation=True)
+        with torch.no_grad():
+            logits = self.model(**inputs).logits
+        return logits.numpy()
+
+    def predict(self, texts: list) -> list:
+        return [labels[i] for i in np.argmax(self.scores(texts), axis=1)]
+
+class OnnxBackend:
+    def __init__(self, model_name: str = MODEL_NAME, onnx_path: str = SENTIMENT_ONNX_PATH, quantize: bool = False):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("SENTIMENT_BACKEND=onnx requires onnxruntime (pip install onnxruntime)")
+        from transformers import AutoTokenizer
+
+        self.name = "onnx-int8" if quantize else "onnx"
+        self.model_name = model_name
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model_path = quantized_onnx_path(onnx_path) if quantize else onnx_path
+        if not os.path.exists(model_path):
+            export_onnx(model_name, onnx_path, int8_path=model_path if quantize else None)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if SENTIMENT_THREADS > 0:
+            options.intra_op_num_threads = SENTIMENT_THREADS
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def scores(self, texts: list) -> np.ndarray:
+        inputs = self.tokenizer(texts, return_tensors="np", padding=True, truncation=True)
+        feeds = {name: inputs[name].astype(np.int64) for name in self.input_names}
+        return self.session.run(None, feeds)[0]
+
+    def predict(self, texts: list) -> list:
+        return [labels[i] for i in np.argmax(self.scores(texts), axis=1)]
+
+# Wire format between workers and sentiment_server.py: 4-byte big-endian length + JSON body
+def send_message(sock, message: dict):
+    body = json.dumps(message).encode("utf-8")
+    sock.sendall(struct.pack(">I", len(body)) + body)
+
+def recv_message(sock) -> dict:
+    header = _recv_exact(sock, 4)
+    if header is None:
+        return None
+    body = _recv_exact(sock, struct.unpack(">I", header)[0])
+    if body is None:
+        raise ConnectionError("sentiment socket closed mid-message")
+    return json.loads(body)
+
+def _recv_exact(sock, size: int):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+class RemoteBackend:
+    # Client for sentiment_server.py. One connection per thread; the server batches across workers.
+    def __init__(self, socket_path: str = SENTIMENT_SOCKET, timeout: float = 30):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.model_name = MODEL_NAME
+        self._local = threading.local()
+        info = self._call({"op": "info"})
+        if info.get("model") != MODEL_NAME:
+            raise RuntimeError(f"Sentiment server at {socket_path} serves {info.get('model')}, expected {MODEL_NAME}")
+        self.name = f"remote:{info.get('backend')}"
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self._local.sock = sock
+        return sock
+
+    def _call(self, message: dict) -> dict:
+        # A stale connection (server restarted) is retried once on a fresh one
+        for attempt in range(2):
+            sock = getattr(self._local, "sock", None) or self._connect()
+            try:
+                send_message(sock, message)
+                reply = recv_message(sock)
+                if reply is None:
+                    raise ConnectionError("sentiment server closed the connection")
+            except OSError:
+                sock.close()
+                self._local.sock = None
+                if attempt:
+                    raise
+                continue
+            if "error" in reply:
+                raise RuntimeError(f"Sentiment server error: {reply['error']}")
+            return reply
+
+    def scores(self, texts: list) -> np.ndarray:
+        return np.array(self._call({"op": "scores", "texts": texts})["scores"], dtype=np.float32)
+
+    def predict(self, texts: list) -> list:
+        return self._call({"op": "predict", "texts": texts})["labels"]
+
+def quantized_onnx_path(onnx_path: str) -> str:
+    root, ext = os.path.splitext(onnx_path)
+    return f"{root}.int8{ext}"
+
+def export_onnx(model_name: str, onnx_path: str, int8_path: str = None):
+    # Exports the fp32 graph to onnx_path; the int8 copy (if requested) is derived from it
+    import torch
+    from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+    os.makedirs(os.path.dirname(onnx_path) or ".", exist_ok=True)
+
+    if not os.path.exists(onnx_path):
+        print(f"Exporting {model_name} to ONNX at {onnx_path}")
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        model.eval()
+        sample = tokenizer(["export sample"], return_tensors="pt")
+        torch.onnx.export(
+            model,
+            (sample["input_ids"], sample["attention_mask"]),
+            onnx_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["logits"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "logits": {0: "batch"},
+            },
+            opset_version=14,
+        )
+
+    if int8_path and not os.path.exists(int8_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        print(f"Quantizing {onnx_path} to int8 at {int8_path}")
+        quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QInt8)
+
+def load_backend(kind: str = SENTIMENT_BACKEND):
+    kind = kind.strip().lower()
+    if kind == "torch":
+        return TorchBackend()
+    if kind == "torch-int8":
+        return TorchBackend(quantize=True)
+    if kind == "onnx":
+        return OnnxBackend()
+    if kind == "onnx-int8":
+        return OnnxBackend(quantize=True)
+    if kind == "remote":
+        return RemoteBackend()
+    raise ValueError(f"Unknown SENTIMENT_BACKEND: {kind}")
+
+_backend = None
+_backend_lock = threading.Lock()
+_warmup = {"status": "cold", "error": None, "seconds": None}
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _warmup["status"] = "loading"
+                start = time.time()
+                try:
+                    _backend = load_backend(SENTIMENT_BACKEND)
+                except Exception as e:
+                    _warmup.update(status="failed", error=str(e))
+                    raise
+                print(f"Sentiment backend '{_backend.name}' loaded in {round(time.time() - start, 2)}s")
+    return _backend
+
+def warmup():
+    # Loads the model and runs one forward pass so the first real request doesn't pay for it
+    if _warmup["status"] == "ready":
+        return
+    start = time.time()
+    try:
+        get_backend().predict(["warmup"])
+    except Exception as e:
+        _warmup.update(status="failed", error=str(e))
+        print("Sentiment warmup failed: ", e)
+        raise
+    _warmup.update(status="ready", error=None, seconds=round(time.time() - start, 2))
+
+def preload():
+    # Loads the weights without running inference. Used before forking workers (gunicorn.conf.py):
+    # the weights are then shared copy-on-write, and torch's thread pools are only created after the
+    # fork, in each worker, by its own warmup.
+    if SENTIMENT_BACKEND == "remote":
+        return
+    get_backend()
+
+def start_background_warmup() -> threading.Thread:
+    def run():
+        try:
+            warmup()
+        except Exception:
+            pass
+    thread = threading.Thread(target=run, name="sentiment-warmup", daemon=True)
+    thread.start()
+    return thread
+
+def is_ready() -> bool:
+    return _warmup["status"] == "ready"
+
+def warmup_status() -> dict:
+    return {"backend": SENTIMENT_BACKEND, **_warmup}
+
+def predict_labels(texts: list) -> list:
+    # One padded forward pass over already-normalized, non-empty texts
+    started = time.perf_counter()
+    labels_out = get_backend().predict(texts)
+    SENTIMENT_SECONDS.observe(time.perf_counter() - started)
+    SENTIMENT_BATCH_SIZE.observe(len(texts))
+    if _warmup["status"] != "ready":
+        _warmup.update(status="ready", error=None)
+    return labels_out
+
+class SentimentBatcher:
+    def __init__(self, predict_fn, max_batch_size: int = 16, max_wait_ms: float = 5):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, text: str) -> Future:
+        self._ensure_started()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sentiment-batcher", daemon=True)
+                self._thread.start()
+
+    def _collect(self) -> list:
+        batch = []
+        self._take(self._queue.get(), batch)
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._take(item, batch)
+        return batch
+
+    @staticmethod
+    def _take(item, batch: list):
+        # Futures whose caller went away (e.g. a cancelled analyze_sentiment_async) are dropped; the
+        # others are marked running so they can no longer be cancelled under us
+        if item[1].set_running_or_notify_cancel():
+            batch.append(item)
+
+    @staticmethod
+    def _resolve(future: Future, result=None, error: Exception = None):
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            pass
+
+    def _run(self):
+        # Must never die: callers block on the futures it resolves
+        while True:
+            batch = []
+            try:
+                batch = self._collect()
+                if not batch:
+                    continue
+                # Identical texts in the same window share one slot in the forward pass
+                unique_texts = list(dict.fromkeys(text for text, _ in batch))
+                results = dict(zip(unique_texts, self.predict_fn(unique_texts)))
+                for text, future in batch:
+                    self._resolve(future, results[text])
+            except Exception as e:
+                print("Sentiment batch error: ", e)
+                for _, future in batch:
+                    self._resolve(future, error=e)
+
+class SentimentCache:
+    # Bounded LRU of label results keyed by (model identity, normalized text)
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            label = self._entries.get(key)
+            if label is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return label
+
+    def put(self, key, label: str):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = label
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+_batcher = SentimentBatcher(predict_labels, SENTIMENT_MAX_BATCH, SENTIMENT_MAX_WAIT_MS)
+_cache = SentimentCache(SENTIMENT_CACHE_SIZE)
+
+def _cache_key(text: str):
+    # Labels from different backends may differ slightly, so the backend is part of the identity
+    return (MODEL_NAME, SENTIMENT_BACKEND, text)
+
+def sentiment_cache_stats() -> dict:
+    return _cache.stats()
+
 def analyze_sentiment(text: str) -> str:
-    text = text.strip().lower()
-    if not text.strip():
+    text = normalize_text(text)
+    if not text:
         return "neutral"
-    inputs = tokenizer(text, return_tensors="pt")
-    with torch.no_grad():
-        logits = model(**inputs).logits
-    predicted_class = torch.argmax(logits, dim=1).item()
-    return labels[predicted_class]
+    cached = _cache.get(_cache_key(text))
+    if cached is not None:
+        return cached
+    if SENTIMENT_MAX_BATCH <= 1:
+        label = predict_labels([text])[0]
+    else:
+        label = _batcher.submit(text).result()
+    _cache.put(_cache_key(text), label)
+    return label
+
+async def analyze_sentiment_async(text: str) -> str:
+    text = normalize_text(text)
+    if not text:
+        return "neutral"
+    cached = _cache.get(_cache_key(text))
+    if cached is not None:
+        return cached
+    label = await asyncio.wrap_future(_batcher.submit(text))
+    _cache.put(_cache_key(text), label)
+    return label
+
+def analyze_sentiment_batch(texts: list) -> list:
+    # For callers that already hold many texts: score the cache misses directly in padded chunks
+    normalized = [normalize_text(t or "") for t in texts]
+    results = ["neutral"] * len(normalized)
+    pending = {}
+    for i, text in enumerate(normalized):
+        if not text:
+            continue
+        cached = _cache.get(_cache_key(text))
+        if cached is not None:
+            results[i] = cached
+        else:
+            pending.setdefault(text, []).append(i)
+    unique_texts = list(pending)
+    chunk_size = max(SENTIMENT_MAX_BATCH, 1)
+    for start in range(0, len(unique_texts), chunk_size):
+        chunk = unique_texts[start:start + chunk_size]
+        for text, label in zip(chunk, predict_labels(chunk)):
+            _cache.put(_cache_key(text), label)
+            for i in pending[text]:
+                results[i] = label
+    return results
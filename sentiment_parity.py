@@ -0,0 +1,104 @@
+# Accuracy-parity check: compares a candidate sentiment backend against the full-precision
+# torch path on the logged dialogues (selection_log.csv and, optionally, the npc_memory table).
+#
+#   python sentiment_parity.py --backend onnx-int8
+#   python sentiment_parity.py --backend torch-int8 --from-db 5000 --min-agreement 0.97
+import argparse, re, sys, time
+import numpy as np
+from sentiment import load_backend, normalize_text, labels
+
+LOG_LINE = re.compile(r"^\d+,(.*),(negative|neutral|positive),(.*)$")
+
+def load_logged_texts(path: str) -> list:
+    # selection_log.csv is not strictly quoted (dialogues contain commas, replies span lines),
+    # so each record is recognised by its "player_id,dialogue,label,reply" first line
+    texts = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            match = LOG_LINE.match(line.rstrip("\n"))
+            if not match:
+                continue
+            dialogue, _, reply = match.groups()
+            texts.append(dialogue)
+            reply = reply.strip().strip('"')
+            if reply:
+                texts.append(reply)
+    return texts
+
+def load_db_texts(limit: int) -> list:
+    from database import SessionLocal
+    from models import NPCMemory
+
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(NPCMemory.dialogue, NPCMemory.npc_reply)
+            .order_by(NPCMemory.id.desc())
+            .limit(limit)
+            .all()
+        )
+    finally:
+        db.close()
+    texts = []
+    for dialogue, reply in rows:
+        texts.append(dialogue)
+        if reply:
+            texts.append(reply)
+    return texts
+
+def score_all(backend, texts: list, batch_size: int):
+    all_scores = []
+    start = time.perf_counter()
+    for i in range(0, len(texts), batch_size):
+        all_scores.append(backend.scores(texts[i:i + batch_size]))
+    elapsed = time.perf_counter() - start
+    return np.concatenate(all_scores), elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare a sentiment backend against the torch reference.")
+    parser.add_argument("--backend", default="onnx-int8", help="torch-int8, onnx or onnx-int8")
+    parser.add_argument("--log", default="selection_log.csv")
+    parser.add_argument("--from-db", type=int, default=0, help="also include the N most recent npc_memory rows")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--min-agreement", type=float, default=0.98)
+    args = parser.parse_args()
+
+    texts = load_logged_texts(args.log)
+    if args.from_db:
+        texts += load_db_texts(args.from_db)
+    texts = [t for t in dict.fromkeys(normalize_text(t) for t in texts) if t]
+    if not texts:
+        print("No logged dialogues found.")
+        return 1
+
+    reference = load_backend("torch")
+    candidate = load_backend(args.backend)
+
+    ref_scores, ref_time = score_all(reference, texts, args.batch_size)
+    cand_scores, cand_time = score_all(candidate, texts, args.batch_size)
+
+    ref_labels = ref_scores.argmax(axis=1)
+    cand_labels = cand_scores.argmax(axis=1)
+    agreement = float((ref_labels == cand_labels).mean())
+    max_logit_diff = float(np.abs(ref_scores - cand_scores).max())
+
+    print(f"Texts compared:      {len(texts)}")
+    print(f"Label agreement:     {agreement:.2%}  (minimum {args.min_agreement:.2%})")
+    print(f"Max |logit diff|:    {max_logit_diff:.4f}")
+    print(f"torch time:          {ref_time:.2f}s ({ref_time / len(texts) * 1000:.1f} ms/text)")
+    print(f"{candidate.name} time: {cand_time:.2f}s ({cand_time / len(texts) * 1000:.1f} ms/text)")
+
+    print("\nConfusion (rows: torch, cols: " + candidate.name + ")")
+    print("            " + " ".join(f"{l:>9}" for l in labels))
+    for i, label in enumerate(labels):
+        counts = [int(((ref_labels == i) & (cand_labels == j)).sum()) for j in range(len(labels))]
+        print(f"{label:>10}  " + " ".join(f"{c:>9}" for c in counts))
+
+    mismatches = [t for t, r, c in zip(texts, ref_labels, cand_labels) if r != c]
+    for text in mismatches[:10]:
+        print(f"  mismatch: {text[:80]!r}")
+
+    return 0 if agreement >= args.min_agreement else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
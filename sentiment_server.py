@@ -0,0 +1,74 @@
+# Dedicated sentiment inference process: loads the model once and serves every app worker over a
+# Unix socket, so N workers cost one copy of the RoBERTa weights and torch runtime instead of N.
+# Requests from all workers go through one micro-batcher, so concurrent turns share forward passes.
+#
+#   SENTIMENT_SERVER_BACKEND=onnx-int8 python sentiment_server.py
+#   SENTIMENT_BACKEND=remote gunicorn main:app -c gunicorn.conf.py
+import os, sys, signal, socketserver
+import numpy as np
+from sentiment import (
+    load_backend, send_message, recv_message, SentimentBatcher, MODEL_NAME, SENTIMENT_SOCKET,
+    SENTIMENT_MAX_BATCH, SENTIMENT_MAX_WAIT_MS,
+)
+
+SENTIMENT_SERVER_BACKEND = os.getenv("SENTIMENT_SERVER_BACKEND", "torch")
+
+backend = None
+batcher = None
+
+class Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # One persistent connection per worker thread; messages are handled in order
+        while True:
+            try:
+                message = recv_message(self.request)
+            except (OSError, ValueError):
+                return
+            if message is None:
+                return
+            try:
+                reply = dispatch(message)
+            except Exception as e:
+                reply = {"error": str(e)}
+            try:
+                send_message(self.request, reply)
+            except OSError:
+                return
+
+def dispatch(message: dict) -> dict:
+    op = message.get("op")
+    if op == "info":
+        return {"model": MODEL_NAME, "backend": backend.name, "pid": os.getpid()}
+    texts = message.get("texts") or []
+    if op == "predict":
+        futures = [batcher.submit(text) for text in texts]
+        return {"labels": [future.result() for future in futures]}
+    if op == "scores":
+        return {"scores": np.asarray(backend.scores(texts)).tolist() if texts else []}
+    return {"error": f"unknown op {op!r}"}
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def main():
+    global backend, batcher
+    backend = load_backend(SENTIMENT_SERVER_BACKEND)
+    backend.predict(["warmup"])
+    # Workers send batches of their own, so the server can gather larger ones
+    batcher = SentimentBatcher(backend.predict, max(SENTIMENT_MAX_BATCH, 32), SENTIMENT_MAX_WAIT_MS)
+
+    if os.path.exists(SENTIMENT_SOCKET):
+        os.remove(SENTIMENT_SOCKET)
+    server = Server(SENTIMENT_SOCKET, Handler)
+    os.chmod(SENTIMENT_SOCKET, 0o660)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"Sentiment server ({backend.name}) listening on {SENTIMENT_SOCKET}, pid {os.getpid()}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(SENTIMENT_SOCKET):
+            os.remove(SENTIMENT_SOCKET)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+import context_budget
+from context_budget import TokenCountCache, count_tokens, CHARS_PER_TOKEN
+
+def test_counting_does_not_wait_for_the_tokenizer(monkeypatch):
+    # A load in progress holds the lock; counting must fall back to the estimate instead of blocking
+    monkeypatch.setitem(context_budget._loader, "started", True)
+    monkeypatch.setitem(context_budget._tokenizer_state, "status", "not_loaded")
+    with context_budget._tokenizer_lock:
+        assert count_tokens("x" * 40) == 40 // CHARS_PER_TOKEN
+
+def test_estimates_are_not_cached_while_loading(monkeypatch):
+    monkeypatch.setitem(context_budget._loader, "started", True)
+    monkeypatch.setitem(context_budget._tokenizer_state, "status", "not_loaded")
+    cache = TokenCountCache()
+    cache.count("turn", "hello there")
+    assert cache.stats()["size"] == 0
+    monkeypatch.setitem(context_budget._tokenizer_state, "status", "estimate")
+    cache.count("turn", "hello there")
+    assert cache.stats()["size"] == 1
@@ -0,0 +1,106 @@
+import asyncio
+import pytest
+from llm_scheduler import LLMScheduler, LLMBusyError
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_background_waits_for_the_chat_queue():
+    async def scenario():
+        scheduler = LLMScheduler(max_inflight=1, max_queue=4, queue_timeout=5)
+        order = []
+        await scheduler.acquire()                       # a chat generation holds the only slot
+
+        async def job(name, background):
+            await scheduler.acquire(background=background)
+            order.append(name)
+            scheduler.release(background=background)
+
+        fold = asyncio.create_task(job("fold", True))
+        await asyncio.sleep(0)
+        chats = [asyncio.create_task(job(f"chat{i}", False)) for i in range(2)]
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(fold, *chats)
+        return order, scheduler.stats()
+
+    order, stats = run(scenario())
+    assert order == ["chat0", "chat1", "fold"]
+    assert stats["inflight"] == 0 and stats["background_inflight"] == 0
+
+def test_background_slots_are_capped():
+    async def scenario():
+        scheduler = LLMScheduler(max_inflight=3, max_queue=4, queue_timeout=5, max_background=1)
+        await scheduler.acquire(background=True)
+        second = asyncio.create_task(scheduler.acquire(background=True))
+        await asyncio.sleep(0)
+        # A free slot is left for chat even though a fold is waiting
+        await scheduler.acquire()
+        waiting = (not second.done(), scheduler.stats()["background_queued"])
+        scheduler.release(background=True)
+        await second
+        return waiting, scheduler.stats()
+
+    waiting, stats = run(scenario())
+    assert waiting == (True, 1)
+    assert stats["inflight"] == 2 and stats["background_inflight"] == 1
+
+def test_waiters_are_admitted_in_order():
+    async def scenario():
+        scheduler = LLMScheduler(max_inflight=1, max_queue=4, queue_timeout=5)
+        order = []
+
+        async def job(name):
+            await scheduler.run(lambda: asyncio.sleep(0.01), None)
+            order.append(name)
+
+        await asyncio.gather(*(job(i) for i in range(4)))
+        return order, scheduler.stats()
+
+    order, stats = run(scenario())
+    assert order == [0, 1, 2, 3]
+    assert stats["admitted"] == 4 and stats["inflight"] == 0 and stats["queued"] == 0
+
+def test_full_queue_is_rejected_with_a_retry_hint():
+    async def scenario():
+        scheduler = LLMScheduler(max_inflight=1, max_queue=1, queue_timeout=5)
+        await scheduler.acquire()
+        queued = asyncio.create_task(scheduler.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(LLMBusyError) as busy:
+            await scheduler.acquire()
+        scheduler.release()
+        await queued
+        scheduler.release()
+        return busy.value, scheduler.stats()
+
+    error, stats = run(scenario())
+    assert error.reason == "queue_full" and error.retry_after >= 1
+    assert stats["rejected"] == 1 and stats["inflight"] == 0
+
+def test_queue_timeout_gives_up_the_place_in_line():
+    async def scenario():
+        scheduler = LLMScheduler(max_inflight=1, max_queue=4, queue_timeout=5)
+        await scheduler.acquire()
+        with pytest.raises(LLMBusyError) as busy:
+            await scheduler.acquire(queue_timeout=0.01)
+        scheduler.release()
+        return busy.value, scheduler.stats()
+
+    error, stats = run(scenario())
+    assert error.reason == "queue_timeout"
+    assert stats["timed_out"] == 1 and stats["queued"] == 0 and stats["inflight"] == 0
+
+def test_cancelled_waiter_does_not_leak_a_slot():
+    async def scenario():
+        scheduler = LLMScheduler(max_inflight=1, max_queue=4, queue_timeout=5)
+        await scheduler.acquire()
+        waiter = asyncio.create_task(scheduler.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        scheduler.release()
+        return scheduler.stats()
+
+    stats = run(scenario())
+    assert stats["inflight"] == 0 and stats["queued"] == 0
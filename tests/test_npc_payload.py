@@ -0,0 +1,25 @@
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("httpx")
+pytest.importorskip("dotenv")
+from deepseek import build_npc_payload, record_generation, reset_session_context
+
+def turn(id, dialogue, reply):
+    return SimpleNamespace(id=id, dialogue=dialogue, npc_reply=reply)
+
+def test_reused_context_still_gets_recalled_turns():
+    player_id = 9001
+    reset_session_context(player_id)
+    recent = [turn(1, "which tires for Monza?", "Go with the C3 mediums.")]
+    payload = build_npc_payload("and the engine?", "neutral", player_id, recent)
+    assert "system" in payload and "C3 mediums" in payload["prompt"]
+    record_generation(payload, {"context": [1, 2, 3]}, "Take the V8.", player_id, "and the engine?")
+
+    recalled = turn(0, "my rear wing keeps stalling", "Try the low drag wing.")
+    history = [recalled] + recent + [turn(2, "and the engine?", "Take the V8.")]
+    payload = build_npc_payload("what about the wing?", "neutral", player_id, history)
+    assert payload["context"] == [1, 2, 3] and "system" not in payload
+    assert "low drag wing" in payload["prompt"]
+    assert "C3 mediums" not in payload["prompt"] and "Take the V8" not in payload["prompt"]
+    reset_session_context(player_id)
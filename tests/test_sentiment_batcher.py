@@ -0,0 +1,51 @@
+import asyncio, threading
+import pytest
+
+pytest.importorskip("numpy")
+from sentiment import SentimentBatcher
+
+def test_batches_and_deduplicates_texts():
+    calls = []
+    def predict(texts):
+        calls.append(list(texts))
+        return [f"label:{t}" for t in texts]
+    batcher = SentimentBatcher(predict, max_batch_size=8, max_wait_ms=50)
+    futures = [batcher.submit(t) for t in ["a", "b", "a"]]
+    assert [f.result(timeout=2) for f in futures] == ["label:a", "label:b", "label:a"]
+    assert sorted(t for call in calls for t in call) == ["a", "b"]
+
+def test_predict_error_fails_the_batch_and_keeps_the_thread():
+    fail = threading.Event()
+    fail.set()
+    def predict(texts):
+        if fail.is_set():
+            fail.clear()
+            raise RuntimeError("model exploded")
+        return ["ok"] * len(texts)
+    batcher = SentimentBatcher(predict, max_batch_size=4, max_wait_ms=1)
+    with pytest.raises(RuntimeError):
+        batcher.submit("x").result(timeout=2)
+    assert batcher.submit("y").result(timeout=2) == "ok"
+    assert batcher._thread.is_alive()
+
+def test_cancelled_callers_do_not_kill_the_thread():
+    release = threading.Event()
+    def predict(texts):
+        release.wait(2)
+        return ["ok"] * len(texts)
+    batcher = SentimentBatcher(predict, max_batch_size=4, max_wait_ms=1)
+
+    async def cancel_one():
+        # An async caller that goes away (client disconnect) while its text is queued or scoring
+        task = asyncio.ensure_future(asyncio.wrap_future(batcher.submit("gone")))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        queued = asyncio.ensure_future(asyncio.wrap_future(batcher.submit("queued")))
+        await asyncio.sleep(0)
+        queued.cancel()
+        await asyncio.gather(task, queued, return_exceptions=True)
+
+    asyncio.run(cancel_one())
+    release.set()
+    assert batcher.submit("next").result(timeout=2) == "ok"
+    assert batcher._thread.is_alive()
@@ -0,0 +1,31 @@
+import time
+import pytest
+
+pytest.importorskip("httpx")
+pytest.importorskip("dotenv")
+from deepseek import is_small_talk, small_talk_reply, SMALL_TALK_MAX_CHARS
+
+@pytest.mark.parametrize("text", ["hi", "Hey Dax, how are you doing today?", "how are you doing", "good morning there buddy", "hello what's new"])
+def test_greetings_are_small_talk(text):
+    assert is_small_talk(text)
+
+@pytest.mark.parametrize("text", ["", "dax", "which engine should I pick?", "hi, slicks or wets?"])
+def test_other_messages_are_not_small_talk(text):
+    assert not is_small_talk(text)
+
+def test_overlapping_phrases_stay_linear():
+    # "how are you doing" is also "how are you" + filler "doing"; a backtracking regex blew up here
+    started = time.perf_counter()
+    assert not is_small_talk("how are you doing " * 4 + "x")
+    assert not is_small_talk("how are you doing " * 20000 + "x")
+    assert time.perf_counter() - started < 0.5
+
+def test_long_messages_skip_the_fast_path():
+    assert not is_small_talk("hi " * (SMALL_TALK_MAX_CHARS // 3 + 1))
+
+def test_reply_uses_name_and_build():
+    class Build:
+        chassis, engine, tires, frontWing, rearWing = "Standard Monocoque", "2006 V8", "C5 Slick", "High Lift", "Low Drag"
+    reply = small_talk_reply("hi", "Sam", Build())
+    assert "Sam" in reply
+    assert "chassis choices" not in reply
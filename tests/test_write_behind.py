@@ -0,0 +1,56 @@
+import os
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("dotenv")
+sqlalchemy = pytest.importorskip("sqlalchemy")
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from database import Base
+from models import NPCMemory
+import write_behind
+from write_behind import WriteBehindWriter
+
+@pytest.fixture
+def session_factory():
+    engine = sqlalchemy.create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+def test_queued_rows_are_committed_in_batches(session_factory):
+    writer = WriteBehindWriter(session_factory, max_queue=100, batch_size=3, flush_ms=50)
+    for i in range(7):
+        assert writer.enqueue(1 + i % 2, 1, f"message {i}", "neutral", f"reply {i}", "neutral")
+    assert writer.wait_for_player(1) and writer.wait_for_player(2)
+    assert not writer.has_pending(1) and not writer.has_pending(2)
+
+    db = session_factory()
+    try:
+        rows = db.query(NPCMemory).order_by(NPCMemory.id).all()
+    finally:
+        db.close()
+    assert [row.dialogue for row in rows] == [f"message {i}" for i in range(7)]
+    assert all(row.dialogue_hash for row in rows)
+    assert writer.stats() == {"queued": 0, "written": 7, "dropped": 0}
+
+def test_full_queue_asks_for_a_synchronous_write(session_factory):
+    writer = WriteBehindWriter(session_factory, max_queue=1, batch_size=1, flush_ms=50)
+    writer._ensure_started = lambda: None     # no consumer, so the queue stays full
+    assert writer.enqueue(1, 1, "first", "neutral", "reply", "neutral")
+    assert not writer.enqueue(1, 1, "second", "neutral", "reply", "neutral")
+
+def test_failed_batches_are_dropped_and_release_waiters(monkeypatch):
+    class BrokenSession:
+        def bulk_insert_mappings(self, model, rows):
+            raise RuntimeError("database is down")
+        def commit(self): pass
+        def rollback(self): pass
+        def close(self): pass
+
+    monkeypatch.setattr(write_behind, "WRITE_BEHIND_RETRIES", 1)
+    writer = WriteBehindWriter(BrokenSession, max_queue=10, batch_size=5, flush_ms=10)
+    writer.enqueue(1, 1, "lost", "neutral", "reply", "neutral")
+    assert writer.wait_for_player(1, timeout=5)
+    assert writer.stats()["dropped"] == 1
@@ -1,5 +1,10 @@
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
 from fastapi import HTTPException
+from collections import OrderedDict
+from datetime import datetime
+from models import TurboTomState
+import os, re, threading
 
 TOM_TREE = {
     "start": {
@@ -35,21 +40,137 @@ TOM_TREE = {
     }
 }
 
-# in-memory state per player (for demo only—consider DB in long run)
-PLAYER_STATE = {}
+# Option labels precompiled into per-state lookup tables keyed by the normalized label, so matching
+# a reply is one dict lookup instead of lowercasing and comparing every label
+def normalize_option(text: str) -> str:
+    text = text.lower().replace("’", "'").replace("‘", "'")
+    return re.sub(r"\s+", " ", text).strip(" .!?")
+
+TOM_OPTIONS = {
+    state: {normalize_option(label): next_state for label, next_state in node["options"].items()}
+    for state, node in TOM_TREE.items()
+}
+
+# Where each player is in the walkthrough. TOM_STATE_STORE=db (default) keeps it in the turbotom_state
+# table, shared by all workers, with an LRU memory tier in front; TOM_STATE_STORE=memory is the
+# single-process variant. Transitions are compare-and-set on a version number, so two workers
+# answering the same player can't both advance from the same step.
+TOM_STATE_STORE = os.getenv("TOM_STATE_STORE", "db")
+TOM_STATE_CACHE_SIZE = int(os.getenv("TOM_STATE_CACHE_SIZE", "10000"))
+TOM_CAS_RETRIES = 3
+
+class MemoryStateStore:
+    may_be_stale = False
+
+    def __init__(self, max_players: int = 10000):
+        self.max_players = max_players
+        self._entries = OrderedDict()   # player_id -> (state, version)
+        self._lock = threading.Lock()
+
+    def get(self, db, player_id: int, fresh: bool = False):
+        with self._lock:
+            entry = self._entries.get(player_id)
+            if entry is not None:
+                self._entries.move_to_end(player_id)
+            return entry
+
+    def put(self, player_id: int, state: str, version: int):
+        with self._lock:
+            self._entries[player_id] = (state, version)
+            self._entries.move_to_end(player_id)
+            while len(self._entries) > self.max_players:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, player_id: int):
+        with self._lock:
+            self._entries.pop(player_id, None)
+
+    def compare_and_set(self, db, player_id: int, version: int, state: str) -> bool:
+        with self._lock:
+            current = self._entries.get(player_id)
+            if (current[1] if current else 0) != version:
+                return False
+        self.put(player_id, state, version + 1)
+        return True
+
+class DBStateStore:
+    # turbotom_state rows, read and written in the request's session
+    may_be_stale = False
+
+    def get(self, db, player_id: int, fresh: bool = False):
+        row = db.query(TurboTomState).filter(TurboTomState.player_id == player_id).first()
+        return (row.state, row.version) if row else None
+
+    def compare_and_set(self, db, player_id: int, version: int, state: str) -> bool:
+        try:
+            if version == 0:
+                db.add(TurboTomState(player_id=player_id, state=state, version=1, updated_at=datetime.utcnow()))
+                updated = 1
+            else:
+                updated = db.query(TurboTomState).filter(
+                    TurboTomState.player_id == player_id,
+                    TurboTomState.version == version,
+                ).update({"state": state, "version": version + 1, "updated_at": datetime.utcnow()}, synchronize_session=False)
+            db.commit()
+        except IntegrityError:
+            # Another worker created the row first
+            db.rollback()
+            return False
+        return updated == 1
+
+class TieredStateStore:
+    # LRU memory tier over the shared store. A cached entry can be stale when another worker moved the
+    # player on, but every transition is a compare-and-set against the shared version, so a stale
+    # entry only costs a retry. Non-matching replies re-read the shared store before answering.
+    may_be_stale = True
+
+    def __init__(self, shared, max_players: int = 10000):
+        self.shared = shared
+        self.memory = MemoryStateStore(max_players)
+
+    def get(self, db, player_id: int, fresh: bool = False):
+        entry = None if fresh else self.memory.get(db, player_id)
+        if entry is None:
+            entry = self.shared.get(db, player_id)
+            if entry is not None:
+                self.memory.put(player_id, *entry)
+        return entry
+
+    def compare_and_set(self, db, player_id: int, version: int, state: str) -> bool:
+        if self.shared.compare_and_set(db, player_id, version, state):
+            self.memory.put(player_id, state, version + 1)
+            return True
+        self.memory.invalidate(player_id)
+        return False
+
+def make_state_store(kind: str = TOM_STATE_STORE):
+    if kind == "memory":
+        return MemoryStateStore(TOM_STATE_CACHE_SIZE)
+    if kind == "db":
+        return TieredStateStore(DBStateStore(), TOM_STATE_CACHE_SIZE)
+    raise ValueError(f"Unknown TOM_STATE_STORE: {kind}")
+
+state_store = make_state_store()
 
 def turbotom_response(dialogue: str, player_id: int, db: Session) -> str:
-    # initialize state
-    state = PLAYER_STATE.get(player_id, "start")
-    node = TOM_TREE.get(state)
-    if not node:
-        raise HTTPException(500, "TurboTom state error.")
-
-    # if user reply matches an option label, advance
-    for label, next_state in node["options"].items():
-        if dialogue.strip().lower() == label.lower():
-            PLAYER_STATE[player_id] = next_state
-            node = TOM_TREE[next_state]
-            return node["npc"]
-    # fallback
-    return node["npc"]
\ No newline at end of file
+    reply = normalize_option(dialogue)
+    fresh = False
+    for _ in range(TOM_CAS_RETRIES):
+        entry = state_store.get(db, player_id, fresh)
+        state, version = entry or ("start", 0)
+        node = TOM_TREE.get(state)
+        if not node:
+            raise HTTPException(500, "TurboTom state error.")
+
+        # if user reply matches an option label, advance
+        next_state = TOM_OPTIONS[state].get(reply)
+        if next_state is None:
+            if fresh or not state_store.may_be_stale:
+                # fallback
+                return node["npc"]
+            fresh = True  # the cached step may be stale; confirm against the shared store
+            continue
+        if state_store.compare_and_set(db, player_id, version, next_state):
+            return TOM_TREE[next_state]["npc"]
+        fresh = True
+    raise HTTPException(409, "TurboTom state changed concurrently, please retry.")
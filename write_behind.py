@@ -0,0 +1,166 @@
+import os, time, queue, threading
+from datetime import datetime
+from models import NPCMemory, hash_dialogue
+from sentiment import analyze_sentiment_batch
+
+# Optional write-behind persistence for chat turns: the reply is returned as soon as the row is
+# queued, and a background thread scores the NPC sentiment and bulk-inserts queued rows in batches.
+# Readers that need the player's latest rows call wait_for_player() first (read-your-writes).
+NPC_WRITE_BEHIND = os.getenv("NPC_WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", "10000"))
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "200"))
+WRITE_BEHIND_FLUSH_MS = float(os.getenv("WRITE_BEHIND_FLUSH_MS", "200"))
+WRITE_BEHIND_RETRIES = 3
+
+class WriteBehindWriter:
+    def __init__(self, session_factory, max_queue: int = 10000, batch_size: int = 200, flush_ms: float = 200):
+        self.session_factory = session_factory
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_ms / 1000
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = {}                  # player_id -> rows queued but not yet committed
+        self._pending_changed = threading.Condition()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, player_id: int, npc_id: int, dialogue: str, sentiment: str, npc_reply: str, npc_sentiment: str = None) -> bool:
+        # Returns False when the queue is full so the caller can fall back to a synchronous write
+        if self._stopping:
+            return False
+        self._ensure_started()
+        row = {
+            "player_id": player_id,
+            "npc_id": npc_id,
+            "dialogue": dialogue,
+            "dialogue_hash": hash_dialogue(dialogue),
+            "sentiment": sentiment,
+            "timestamp": datetime.utcnow(),
+            "npc_reply": npc_reply,
+            "npc_sentiment": npc_sentiment,
+        }
+        with self._pending_changed:
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                return False
+            self._pending[player_id] = self._pending.get(player_id, 0) + 1
+        return True
+
+    def has_pending(self, player_id: int) -> bool:
+        with self._pending_changed:
+            return self._pending.get(player_id, 0) > 0
+
+    def wait_for_player(self, player_id: int, timeout: float = 5) -> bool:
+        # Blocks until every row queued for this player is committed (or the timeout expires)
+        if not self.has_pending(player_id):
+            return True
+        self._wake.set()
+        deadline = time.monotonic() + timeout
+        with self._pending_changed:
+            while self._pending.get(player_id, 0) > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._pending_changed.wait(remaining)
+        return True
+
+    def flush(self, timeout: float = 30) -> bool:
+        deadline = time.monotonic() + timeout
+        self._wake.set()
+        with self._pending_changed:
+            while self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._pending_changed.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 30):
+        # Flush on shutdown: stop accepting rows, then drain the queue
+        self._stopping = True
+        if self._thread is None:
+            return
+        if not self.flush(timeout):
+            print(f"Write-behind: shutdown flush timed out with {self._queue.qsize()} rows still queued")
+
+    def stats(self) -> dict:
+        return {"queued": self._queue.qsize(), "written": self.written, "dropped": self.dropped}
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="npc-write-behind", daemon=True)
+                self._thread.start()
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if self._wake.is_set() or self._stopping:
+                remaining = 0
+            else:
+                remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self._wake.clear()
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._write(batch)
+            finally:
+                with self._pending_changed:
+                    for row in batch:
+                        count = self._pending.get(row["player_id"], 0) - 1
+                        if count > 0:
+                            self._pending[row["player_id"]] = count
+                        else:
+                            self._pending.pop(row["player_id"], None)
+                    self._pending_changed.notify_all()
+
+    def _write(self, batch: list):
+        unscored = [row for row in batch if row["npc_sentiment"] is None]
+        if unscored:
+            try:
+                for row, label in zip(unscored, analyze_sentiment_batch([row["npc_reply"] or "" for row in unscored])):
+                    row["npc_sentiment"] = label
+            except Exception as e:
+                # Rows are still worth keeping; npc_sentiment can be backfilled later
+                print("Write-behind: NPC sentiment scoring failed: ", e)
+
+        for attempt in range(1, WRITE_BEHIND_RETRIES + 1):
+            db = self.session_factory()
+            try:
+                db.bulk_insert_mappings(NPCMemory, batch)
+                db.commit()
+                self.written += len(batch)
+                return
+            except Exception as e:
+                db.rollback()
+                print(f"Write-behind: bulk insert of {len(batch)} rows failed (attempt {attempt}): ", e)
+                time.sleep(0.5 * attempt)
+            finally:
+                db.close()
+        self.dropped += len(batch)
+        print(f"Write-behind: dropped {len(batch)} rows after {WRITE_BEHIND_RETRIES} attempts")
+
+writer = None
+
+def get_writer(session_factory=None) -> WriteBehindWriter:
+    global writer
+    if writer is None:
+        if session_factory is None:
+            from database import SessionLocal
+            session_factory = SessionLocal
+        writer = WriteBehindWriter(session_factory, WRITE_BEHIND_QUEUE_SIZE, WRITE_BEHIND_BATCH, WRITE_BEHIND_FLUSH_MS)
+    return writer